@@ -1,6 +1,8 @@
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
+import time
+from contextlib import contextmanager
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -9,9 +11,6 @@ from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from config import Config
-from elasticsearch import Elasticsearch
-from redis import Redis
-import rq
 
 # instantiate extensions as global objects, and then bind them to the
 # application in create_app(config) factory function
@@ -35,6 +34,17 @@ bootstrap = Bootstrap()
 moment = Moment()
 
 
+# record wall time of a create_app() phase into app.startup_spans,
+# see `flask startup-profile` in `app/cli.py`
+@contextmanager
+def _startup_span(app, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        app.startup_spans.append((name, time.perf_counter() - start))
+
+
 # application factory function, to be called by top-level scripts, such as
 # `microblog.py`
 # the application factory pattern prevents the app from being exposed in the
@@ -45,30 +55,40 @@ def create_app(config_class=Config):
     # initialize Flask app with the package name (via __name__ of __init__ file)
     # this is a common practice if Flask app is defined in __init__ file
     app = Flask(__name__)
+    app.startup_spans = []
 
     # config Flask app with Config object, all settings in Config object are
     # loaded to and accessible in app.config as a dictionary
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
 
-    db.init_app(app)
-    migrate.init_app(app, db)
-    login.init_app(app)
-    mail.init_app(app)
-    bootstrap.init_app(app)
-    moment.init_app(app)
+    with _startup_span(app, 'extensions'):
+        db.init_app(app)
+        migrate.init_app(app, db)
+        login.init_app(app)
+        mail.init_app(app)
+        bootstrap.init_app(app)
+        moment.init_app(app)
 
     # register blueprints
     #
-    from app.errors import bp as errors_bp
-    app.register_blueprint(errors_bp)
+    with _startup_span(app, 'blueprints'):
+        from app.errors import bp as errors_bp
+        app.register_blueprint(errors_bp)
+
+        from app.auth import bp as auth_bp
+        # url prefix is optional, it is a good practice to namespace all auth
+        # urls, the `url_for` view helper will auto prefix the given
+        # <bp>.<handler-func>.
+        app.register_blueprint(auth_bp, url_prefix='/auth')
+
+        from app.main import bp as main_bp
+        app.register_blueprint(main_bp)
 
-    from app.auth import bp as auth_bp
-    # url prefix is optional, it is a good practice to namespace all auth urls
-    # the `url_for` view helper will auto prefix the given <bp>.<handler-func>.
-    app.register_blueprint(auth_bp, url_prefix='/auth')
+        from app.avatars import bp as avatars_bp
+        app.register_blueprint(avatars_bp)
 
-    from app.main import bp as main_bp
-    app.register_blueprint(main_bp)
+        from app.api import bp as api_bp
+        app.register_blueprint(api_bp, url_prefix='/api')
 
     if not app.debug and not app.testing:
         if app.config['MAIL_SERVER']:
@@ -103,25 +123,12 @@ def create_app(config_class=Config):
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
 
-    if app.config['ENABLE_ELASTICSEARCH']:
-        # add elasticsearch as app attribute
-        app.elasticsearch = Elasticsearch(
-            [app.config['ELASTICSEARCH_URL']],
-            basic_auth=(app.config['ELASTICSEARCH_USER'], app.config['ELASTICSEARCH_PASSWORD']),
-            verify_certs=None
-        )
-        # disable unverified https warning (due to verify_cert=None option):
-        import urllib3
-        urllib3.disable_warnings()
-        app.logger.info('Elasticsearch initialized')
-        app.logger.info(f'Elasticsearch client info: {app.elasticsearch.info()}')
-    else:
-        app.elasticsearch = None
-
-    # setup redis task queue
-    # this task queue can be access from anywhere via 'current_app'
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    # elasticsearch, redis and the rq task queue are attached as lazy
+    # proxies, the clients are only created on first use, see
+    # `app/services.py`
+    with _startup_span(app, 'services'):
+        from app import services
+        services.init_app(app)
 
     return app
 
@@ -0,0 +1,7 @@
+from flask import Blueprint
+
+# json api for mobile clients and integrations, see `README.md` for the
+# endpoints and their latency targets
+bp = Blueprint('api', __name__)
+
+from app.api import responses, auth, tokens, posts
@@ -0,0 +1,43 @@
+# api authentication
+#
+# clients exchange username and password for a bearer token once, with
+# basic auth on `POST /api/tokens`, and send the token with every other
+# request, so that password hashing is not paid per api call
+
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
+from werkzeug.exceptions import ServiceUnavailable
+from app.api.responses import error_response
+from app.models import User
+from app.passwords import PasswordHashBusy
+
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth()
+
+
+@basic_auth.verify_password
+def verify_password(username, password):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return None
+    try:
+        if user.check_password(password):
+            return user
+    except PasswordHashBusy:
+        raise ServiceUnavailable('The server is busy, please try again in a moment',
+                                 retry_after=1)
+    return None
+
+
+@basic_auth.error_handler
+def basic_auth_error(status):
+    return error_response(status)
+
+
+@token_auth.verify_token
+def verify_token(token):
+    return User.check_token(token) if token else None
+
+
+@token_auth.error_handler
+def token_auth_error(status):
+    return error_response(status)
@@ -0,0 +1,121 @@
+# post listing and batch creation
+#
+# lists are cursor paged, newest first: a page ends with the cursor of its
+# last post, and the next page starts after it with a keyset condition on
+# (timestamp, id), so that deep pages cost the same as the first one and
+# posts added meanwhile do not shift pages
+
+import base64
+import binascii
+from datetime import datetime
+from flask import current_app, request
+from app import db, readmodels
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.responses import bad_request, json_response
+from app.models import User, Post, PostArchive
+from app import ratelimit
+
+
+def _encode_cursor(post):
+    value = f'{post.timestamp.isoformat()}|{post.id}'
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        timestamp, id = base64.urlsafe_b64decode(cursor.encode('ascii')) \
+            .decode('utf-8').split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (ValueError, UnicodeError, binascii.Error):
+        return None
+
+
+def _post_dict(post):
+    return {'id': post.id, 'body': post.body, 'timestamp': post.timestamp,
+            'author': {'id': post.author.id, 'username': post.author.username,
+                       'avatar': post.author.avatar(128)}}
+
+
+# posts of a query after the cursor, newest first, as read models
+def _page(query, model, after, limit):
+    query = query.order_by(model.timestamp.desc(), model.id.desc())
+    if after is not None:
+        query = query.filter(db.tuple_(model.timestamp, model.id) < after)
+    return readmodels.load(readmodels.select_posts(query, model).limit(limit))
+
+
+# cursor and limit request arguments, or an error response
+def _paging_args():
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+    cursor = request.args.get('cursor')
+    after = _decode_cursor(cursor) if cursor else None
+    if cursor and after is None:
+        return None, limit, bad_request('invalid cursor')
+    return after, limit, None
+
+
+def _page_response(posts, limit):
+    return json_response({
+        'items': [_post_dict(post) for post in posts],
+        'next_cursor': _encode_cursor(posts[-1]) if len(posts) == limit else None,
+    })
+
+
+# target p95: 50 ms at the max page size
+@bp.route('/posts', methods=['GET'])
+@token_auth.login_required
+def get_posts():
+    after, limit, error = _paging_args()
+    if error:
+        return error
+    return _page_response(_page(Post.query, Post, after, limit), limit)
+
+
+# reads through to the archive past the user's hot posts, which are all
+# newer than the archived ones, see `app/archive.py`
+# target p95: 50 ms at the max page size
+@bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
+def get_user_posts(id):
+    user = User.query.get_or_404(id)
+    after, limit, error = _paging_args()
+    if error:
+        return error
+    posts = _page(user.posts, Post, after, limit)
+    if len(posts) < limit:
+        if posts:
+            after = (posts[-1].timestamp, posts[-1].id)
+        posts += _page(user.archived_posts, PostArchive, after, limit - len(posts))
+    return _page_response(posts, limit)
+
+
+# create up to API_MAX_BATCH posts, {"posts": [{"body": "..."}, ...]}, in
+# one transaction, indexed for search with one bulk request on commit
+# the 'api_posts' rate limit is charged one token per post
+# target p95: 150 ms for a full batch
+@bp.route('/posts', methods=['POST'])
+@token_auth.login_required
+def create_posts():
+    data = request.get_json(silent=True)
+    items = data.get('posts') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return bad_request('expected {"posts": [{"body": "..."}, ...]}')
+    if len(items) > current_app.config['API_MAX_BATCH']:
+        return bad_request(f"at most {current_app.config['API_MAX_BATCH']} posts per request")
+    for item in items:
+        body = item.get('body') if isinstance(item, dict) else None
+        if not isinstance(body, str) or not 0 < len(body.strip()) <= 140:
+            return bad_request('each post needs a body of 1 to 140 characters')
+    author = token_auth.current_user()
+    ratelimit.check('api_posts', by=lambda: f'user:{author.id}', cost=len(items))
+    now = datetime.utcnow()
+    posts = [Post(body=item['body'], author=author, timestamp=now) for item in items]
+    db.session.add_all(posts)
+    # ids are read before the commit expires the posts, reading them after
+    # would reload every post with its own SELECT
+    db.session.flush()
+    ids = [post.id for post in posts]
+    db.session.commit()
+    return json_response({'items': [{'id': id, 'timestamp': now} for id in ids]}, 201)
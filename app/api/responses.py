@@ -0,0 +1,78 @@
+# json responses and per-endpoint latency of the api
+#
+# responses are serialized with orjson when it is installed, several times
+# faster than the json module on lists of posts, with the same output
+# endpoint latency is recorded in `api.<endpoint>` timing stats, exposed with
+# their p95 at `/metrics`, see `app/metrics.py`
+
+import json
+import time
+from datetime import datetime
+from flask import current_app, g, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+from app import db, metrics
+from app.api import bp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat() + '+00:00'
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+# datetimes are utc, serialized as iso 8601 with an explicit offset
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NAIVE_UTC)
+    return json.dumps(payload, default=_default, separators=(',', ':'))
+
+
+def json_response(payload, status=200, headers=None):
+    return current_app.response_class(dumps(payload), status=status, headers=headers,
+                                      mimetype='application/json')
+
+
+def error_response(status, message=None, headers=None):
+    payload = {'error': HTTP_STATUS_CODES.get(status, 'Unknown error')}
+    if message:
+        payload['message'] = message
+    return json_response(payload, status, headers)
+
+
+def bad_request(message):
+    return error_response(400, message)
+
+
+# http errors raised by api views are answered in json instead of the html
+# error pages, the codes with app wide handlers (see `app/errors/handlers.py`)
+# need their own blueprint handler, those take precedence over class handlers
+@bp.errorhandler(HTTPException)
+@bp.errorhandler(404)
+@bp.errorhandler(429)
+@bp.errorhandler(500)
+def http_error(error):
+    if error.code == 500:
+        db.session.rollback()
+    headers = {}
+    if getattr(error, 'retry_after', None):
+        headers['Retry-After'] = str(error.retry_after)
+    return error_response(error.code, error.description, headers)
+
+
+@bp.before_request
+def start_timer():
+    g.api_start = time.perf_counter()
+
+
+@bp.after_request
+def record_latency(response):
+    if 'api_start' in g:
+        metrics.timing_stats(request.endpoint).record(
+            time.perf_counter() - g.api_start)
+    return response
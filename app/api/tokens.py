@@ -0,0 +1,27 @@
+from flask import current_app
+from app import db
+from app.api import bp
+from app.api.auth import basic_auth, token_auth
+from app.api.responses import json_response
+from app.ratelimit import rate_limit
+
+
+# target p95: 300 ms, bounded by password hashing
+@bp.route('/tokens', methods=['POST'])
+@rate_limit('login', by='ip')
+@basic_auth.login_required
+def get_token():
+    user = basic_auth.current_user()
+    token = user.get_token(current_app.config['API_TOKEN_EXPIRATION'])
+    # also stores a password hash upgraded by check_password()
+    db.session.commit()
+    return json_response({'token': token, 'expires': user.token_expiration})
+
+
+# target p95: 20 ms
+@bp.route('/tokens', methods=['DELETE'])
+@token_auth.login_required
+def revoke_token():
+    token_auth.current_user().revoke_token()
+    db.session.commit()
+    return '', 204
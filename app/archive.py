@@ -0,0 +1,89 @@
+# hot/cold post archival
+#
+# almost all reads hit recent posts, so `flask posts archive` moves posts
+# older than a cutoff from the post table into post_archive, keeping their
+# ids, and the post table with its indexes stays small:
+# - rows are moved in batches of INSERT ... SELECT and DELETE, one
+#   transaction per batch, so a batch is either in one table or the other
+# - the bulk statements bypass the post counter events, archived posts keep
+#   counting in User.post_count and the 'posts' counter, and are added to
+#   the 'archived_posts' counter, see `app/models.py`
+# - archived posts are dropped from the timeline cache, and optionally from
+#   the search index
+# - the post with the highest id, and posts newer than it, are never
+#   archived: without AUTOINCREMENT (sqlite rowids, mysql < 8.0 after a
+#   restart) new posts would reuse the ids of archived posts
+#
+# the user timeline reads the post table first and only reads through to
+# the archive once pagination goes past the user's hot posts. this relies on
+# archived posts being older than every hot post, which holds as long as
+# posts are not inserted with old timestamps
+
+from datetime import datetime
+from flask_sqlalchemy import Pagination
+from app import db, readmodels, timeline
+from app.models import Post, PostArchive, Counter
+from app.search import remove_ids_from_index
+
+
+def _move_batch(cutoff, batch_size):
+    posts, archive = Post.__table__, PostArchive.__table__
+    last = db.session.execute(db.select([posts.c.id, posts.c.timestamp])
+                              .order_by(posts.c.id.desc()).limit(1)).first()
+    if last is None:
+        return []
+    # posts older than the last post, or as old and with a lower id
+    ids = [row[0] for row in db.session.execute(
+        db.select([posts.c.id]).where(
+            posts.c.timestamp < cutoff, posts.c.timestamp <= last.timestamp,
+            posts.c.id < last.id)
+        .order_by(posts.c.timestamp, posts.c.id).limit(batch_size))]
+    if not ids:
+        return ids
+    columns = ['id', 'body', 'timestamp', 'user_id']
+    db.session.execute(archive.insert().from_select(
+        columns + ['archived_at'],
+        db.select([posts.c[name] for name in columns] +
+                  [db.literal(datetime.utcnow(), db.DateTime)])
+        .where(posts.c.id.in_(ids))))
+    db.session.execute(posts.delete().where(posts.c.id.in_(ids)))
+    counters = Counter.__table__
+    result = db.session.execute(counters.update().where(
+        counters.c.name == 'archived_posts').values(value=counters.c.value + len(ids)))
+    if result.rowcount == 0:
+        db.session.execute(counters.insert().values(name='archived_posts', value=len(ids)))
+    db.session.commit()
+    return ids
+
+
+# move posts older than the cutoff datetime to the archive, returns the
+# number of moved posts
+def archive_posts(cutoff, batch_size=1000, unindex=False):
+    moved = 0
+    while True:
+        ids = _move_batch(cutoff, batch_size)
+        if not ids:
+            return moved
+        moved += len(ids)
+        timeline.remove_posts(ids)
+        if unindex:
+            remove_ids_from_index(Post.__tablename__, ids)
+
+
+# a page of the posts of a user as read models, newest first, over the post table and the
+# archive, `total` is the user's post count including archived posts
+def user_posts(user, page, per_page, total):
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+    items = readmodels.load(readmodels.select_posts(
+        user.posts.order_by(Post.timestamp.desc(), Post.id.desc()))
+        .offset(offset).limit(per_page))
+    if len(items) < per_page and offset + len(items) < total:
+        # past the hot range, the number of hot posts is only counted when
+        # the whole page comes from the archive
+        hot_count = offset + len(items) if items else user.posts.count()
+        items += readmodels.load(readmodels.select_posts(
+            user.archived_posts.order_by(PostArchive.timestamp.desc(),
+                                         PostArchive.id.desc()), PostArchive)
+            .offset(offset + len(items) - hot_count).limit(per_page - len(items)))
+    return Pagination(None, page, per_page, total, items)
@@ -4,6 +4,7 @@ from wtforms.validators import ValidationError
 from wtforms.validators import DataRequired
 from wtforms.validators import Email
 from wtforms.validators import EqualTo, Length
+from app import bloom
 from app.models import User
 
 
@@ -28,7 +29,10 @@ class RegistrationForm(FlaskForm):
 
     # username unique check
     # note that the username is of Field type
+    # usernames the bloom filter has never seen skip the database lookup
     def validate_username(self, username):
+        if not bloom.might_exist('username', username.data):
+            return
         user = User.query.filter_by(username=username.data).first()
         if user is not None:
             raise ValidationError('Username already taken, please use a different username')
@@ -36,6 +40,8 @@ class RegistrationForm(FlaskForm):
     # email unique check
     # note that email argument is of Field type
     def validate_email(self, email):
+        if not bloom.might_exist('email', email.data):
+            return
         user = User.query.filter_by(email=email.data).first()
         if user is not None:
             raise ValidationError('Email already taken, please use a different email')
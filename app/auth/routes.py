@@ -2,13 +2,24 @@ from flask import render_template, flash, redirect, url_for
 from flask import request
 from flask_login import current_user, login_user, logout_user
 from werkzeug.urls import url_parse
+from sqlalchemy.exc import IntegrityError
 from app import db
 from app.auth import bp
 from app.auth.forms import LoginForm, RegistrationForm
 from app.models import User
+from app.passwords import PasswordHashBusy
+from app.ratelimit import rate_limit
+
+
+# password hashing is bounded per process, when all slots are taken the
+# form is sent back with a 503 instead of queueing more cpu work
+def _busy(template, title, form):
+    flash('The server is busy, please try again in a moment', category='error')
+    return render_template(template, title=title, form=form), 503, {'Retry-After': '1'}
 
 
 @bp.route('/login', methods=['GET', 'POST'])
+@rate_limit('login', methods=['POST'], by='ip')
 def login():
     # use flask-login extension provided mixin methods
     if current_user.is_authenticated:
@@ -20,10 +31,17 @@ def login():
     # form content in the request POST body.
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user is None or not user.check_password(form.password.data):
+        try:
+            authenticated = user is not None and user.check_password(form.password.data)
+        except PasswordHashBusy:
+            return _busy('auth/login.html', 'Sign In', form)
+        if not authenticated:
             flash(f'Login failed for user {form.username.data}', category='error')
             return redirect(url_for('auth.login'))
 
+        # store the password hash if it was upgraded to the current hash
+        # parameters by check_password()
+        db.session.commit()
         # register authenticated user
         login_user(user, remember=form.remember_me.data)
         # after login success, redirect user to last intended url
@@ -56,9 +74,20 @@ def register():
     form = RegistrationForm()
     if form.validate_on_submit():
         user = User(username=form.username.data, email=form.email.data)
-        user.set_password(form.password.data)
+        try:
+            user.set_password(form.password.data)
+        except PasswordHashBusy:
+            return _busy('auth/register.html', 'Register', form)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # the unique indexes have the final word on taken names, see
+            # `app/bloom.py`
+            db.session.rollback()
+            flash('Username or email already taken, please use a different one',
+                  category='error')
+            return render_template('auth/register.html', title='Register', form=form)
         flash('You have successfully registered')
         return redirect(url_for('auth.login'))
 
@@ -0,0 +1,7 @@
+from flask import Blueprint
+
+# local identicon avatars, served instead of gravatar when LOCAL_AVATARS is
+# set, see `app/models.py` avatar_url()
+bp = Blueprint('avatars', __name__)
+
+from app.avatars import routes
@@ -0,0 +1,25 @@
+# identicons drawn from an avatar digest, a 5x5 grid mirrored around the
+# middle column with a color taken from the digest, as svg so that one
+# drawing scales to any size
+#
+# drawing one is cheaper than reading a file, so identicons are rendered on
+# every request and never stored, a digest always renders the same image
+
+_SVG = ('<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+        'viewBox="0 0 5 5" shape-rendering="crispEdges">'
+        '<rect width="5" height="5" fill="#f0f0f0"/>'
+        '<path fill="hsl({hue},{saturation}%,{lightness}%)" d="{path}"/></svg>')
+
+
+def identicon_svg(digest, size):
+    nibbles = [int(c, 16) for c in digest]
+    path = []
+    # the first 15 nibbles switch the cells of the left three columns on or off
+    for x in range(3):
+        for y in range(5):
+            if nibbles[x * 5 + y] % 2 == 0:
+                for column in {x, 4 - x}:
+                    path.append(f'M{column} {y}h1v1h-1z')
+    hue = int(digest[-7:], 16) * 360 // 0x10000000
+    return _SVG.format(size=size, hue=hue, saturation=45 + nibbles[15] * 2,
+                       lightness=45 + nibbles[16], path=''.join(path))
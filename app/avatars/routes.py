@@ -0,0 +1,23 @@
+import re
+from flask import abort, current_app, make_response, request
+from app.avatars import bp
+from app.avatars.identicon import identicon_svg
+
+_DIGEST = re.compile(r'[0-9a-f]{32}')
+MAX_SIZE = 512
+
+
+# identicon of an avatar digest, sent with long lived cache headers as the
+# image of a digest never changes, and an etag to revalidate it
+@bp.route('/avatars/<digest>/<int:size>')
+def identicon(digest, size):
+    if not current_app.config['LOCAL_AVATARS'] or not _DIGEST.fullmatch(digest) \
+            or not 0 < size <= MAX_SIZE:
+        abort(404)
+    response = make_response(identicon_svg(digest, size))
+    response.mimetype = 'image/svg+xml'
+    response.set_etag(f'{digest}-{size}')
+    response.cache_control.max_age = current_app.config['AVATAR_CACHE_MAX_AGE']
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
@@ -0,0 +1,173 @@
+# bloom filter of taken usernames and emails
+#
+# registration and profile forms check uniqueness with a database lookup,
+# the filter answers "definitely not taken" for most new names without one.
+# a bloom filter has no false negatives as long as every taken value was
+# added, so:
+# - the filter is built from the user table, and new values are added by
+#   User insert/update mapper events, see `app/models.py`
+# - until the filter is built, or on redis errors, every value is reported
+#   as possibly taken and the database is checked as before
+# - values are added in lower case, which only adds positives on databases
+#   with case insensitive collations
+# - the unique database indexes stay the final authority, a value missed by
+#   the filter (e.g. added by another process while a 'memory' filter was
+#   built) fails the commit with an IntegrityError, see `app/auth/routes.py`
+#
+# UNIQUENESS_BLOOM config selects the storage, 'redis' keeps one bitmap
+# shared by all processes, 'memory' keeps a bit array per process
+
+import math
+import threading
+from flask import current_app
+from redis.exceptions import RedisError
+from app import hashing, locks
+
+BITS_KEY = 'bloom:users'
+READY_KEY = 'bloom:users:ready'
+REBUILD_LOCK_KEY = 'bloom:users:rebuilding'
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        # optimal bit count and number of hash functions for the capacity
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+
+    # bit offsets of a value
+    def positions(self, value):
+        return hashing.positions(value, self.hashes, self.size)
+
+    # bitmap with the given values, in redis bit order (offset 0 is the most
+    # significant bit of the first byte)
+    def bitmap(self, values):
+        bits = bytearray((self.size + 7) // 8)
+        for value in values:
+            for offset in self.positions(value):
+                bits[offset >> 3] |= 0x80 >> (offset & 7)
+        return bits
+
+
+class MemoryBloomFilter(BloomFilter):
+    def __init__(self, capacity, error_rate):
+        super(MemoryBloomFilter, self).__init__(capacity, error_rate)
+        self.bits = None
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.bits is not None
+
+    def load(self, values):
+        self.bits = self.bitmap(values)
+
+    def add(self, value):
+        if self.bits is None:
+            return
+        for offset in self.positions(value):
+            self.bits[offset >> 3] |= 0x80 >> (offset & 7)
+
+    def might_contain(self, value):
+        bits = self.bits
+        return all(bits[offset >> 3] & (0x80 >> (offset & 7))
+                   for offset in self.positions(value))
+
+
+class RedisBloomFilter(BloomFilter):
+    @property
+    def ready(self):
+        return bool(current_app.redis.exists(READY_KEY))
+
+    # the whole bitmap is replaced in one transaction
+    def load(self, values):
+        pipe = current_app.redis.pipeline()
+        pipe.set(BITS_KEY, bytes(self.bitmap(values)))
+        pipe.set(READY_KEY, 1)
+        pipe.execute()
+
+    def add(self, value):
+        pipe = current_app.redis.pipeline(transaction=False)
+        for offset in self.positions(value):
+            pipe.setbit(BITS_KEY, offset, 1)
+        pipe.execute()
+
+    def might_contain(self, value):
+        pipe = current_app.redis.pipeline(transaction=False)
+        for offset in self.positions(value):
+            pipe.getbit(BITS_KEY, offset)
+        return all(pipe.execute())
+
+
+def _filter():
+    storage = current_app.config['UNIQUENESS_BLOOM']
+    if not storage:
+        return None
+    if 'bloom' not in current_app.extensions:
+        cls = RedisBloomFilter if storage == 'redis' else MemoryBloomFilter
+        current_app.extensions['bloom'] = cls(current_app.config['BLOOM_CAPACITY'],
+                                              current_app.config['BLOOM_ERROR_RATE'])
+    return current_app.extensions['bloom']
+
+
+def _item(field, value):
+    return f'{field}:{value.lower()}'
+
+
+# load the filter with all usernames and emails from the user table
+def rebuild():
+    from app.models import User
+    bloom = _filter()
+    if bloom is None:
+        return 0
+    rows = User.query.with_entities(User.username, User.email).yield_per(1000)
+    count = 0
+    values = []
+    for username, email in rows:
+        count += 1
+        if username:
+            values.append(_item('username', username))
+        if email:
+            values.append(_item('email', email))
+    bloom.load(values)
+    return count
+
+
+def _ensure_ready(bloom):
+    if bloom.ready:
+        return True
+    # only one process (or thread) builds the filter, the others use the
+    # database meanwhile
+    if isinstance(bloom, RedisBloomFilter):
+        return locks.rebuild_once(REBUILD_LOCK_KEY, rebuild, 60)
+    if not bloom.lock.acquire(blocking=False):
+        return False
+    try:
+        rebuild()
+    finally:
+        bloom.lock.release()
+    return True
+
+
+# False means the value is definitely not taken, True means it may be taken
+# (or the filter is not available) and the database has to be checked
+def might_exist(field, value):
+    bloom = _filter()
+    if bloom is None or not value:
+        return True
+    try:
+        if not _ensure_ready(bloom):
+            return True
+        return bloom.might_contain(_item(field, value))
+    except RedisError as e:
+        current_app.logger.warning(f'Bloom filter lookup failed: {e}')
+        return True
+
+
+def add(field, value):
+    bloom = _filter()
+    if bloom is None or not value:
+        return
+    try:
+        bloom.add(_item(field, value))
+    except RedisError as e:
+        current_app.logger.warning(f'Bloom filter update failed: {e}')
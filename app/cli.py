@@ -0,0 +1,202 @@
+# custom flask cli commands, registered by `microblog.py`
+# run `flask --help` to list them
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+import click
+
+# script run in a fresh interpreter by `flask startup-profile`, so that the
+# measured time is a real cold start and not served from sys.modules
+_STARTUP_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+done = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'create_app': done - imported,
+    'total': done - start,
+    'spans': app.startup_spans,
+}))
+'''
+
+
+# run the app startup in a subprocess with `python -X importtime`
+# returns (timings, imports), where imports is a list of
+# (module, self_us, cumulative_us) tuples parsed from the importtime report
+def profile_startup(env=None):
+    basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _STARTUP_SCRIPT],
+        cwd=basedir, env=env, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        # format: "import time: self [us] | cumulative | imported package"
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue  # the header line
+        imports.append((fields[2].strip(), self_us, cumulative_us))
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings, imports
+
+
+# age such as '90d', '12w' or '36h' (days when no unit is given)
+def parse_age(value):
+    units = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+    match = re.fullmatch(r'(\d+)([hdw]?)', value.strip().lower())
+    if not match:
+        raise click.BadParameter(f'invalid age {value!r}, use e.g. 90d, 12w or 36h',
+                                 param_hint='--older-than')
+    return timedelta(**{units[match.group(2) or 'd']: int(match.group(1))})
+
+
+def register(app):
+    @app.cli.command('startup-profile')
+    @click.option('--top', default=15, help='Number of slowest imports to show.')
+    def startup_profile(top):
+        """Profile a cold application startup."""
+        timings, imports = profile_startup()
+        click.echo(f"startup total: {timings['total'] * 1000:.1f} ms "
+                   f"(imports {timings['import'] * 1000:.1f} ms, "
+                   f"create_app {timings['create_app'] * 1000:.1f} ms)")
+        click.echo('create_app spans:')
+        for name, seconds in timings['spans']:
+            click.echo(f'  {name:<20} {seconds * 1000:8.1f} ms')
+        click.echo('slowest imports (cumulative):')
+        imports.sort(key=lambda i: i[2], reverse=True)
+        for module, self_us, cumulative_us in imports[:top]:
+            click.echo(f'  {module:<40} {cumulative_us / 1000:8.1f} ms '
+                       f'(self {self_us / 1000:.1f} ms)')
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter commands."""
+        pass
+
+    @counters.command('rebuild')
+    def rebuild_counters():
+        """Backfill or repair post counters from the post and archive tables."""
+        from app.models import rebuild_post_counters
+        drifted = rebuild_post_counters()
+        click.echo(f'Post counters rebuilt, {drifted} counter(s) repaired')
+
+    @app.cli.group()
+    def posts():
+        """Post storage commands."""
+        pass
+
+    @posts.command('archive')
+    @click.option('--older-than', required=True,
+                  help='Age of the posts to archive, e.g. 90d, 12w or 36h.')
+    @click.option('--batch-size', default=1000, help='Posts moved per transaction.')
+    @click.option('--unindex', is_flag=True,
+                  help='Also remove archived posts from the search index.')
+    def archive_posts(older_than, batch_size, unindex):
+        """Move old posts from the post table to the archive."""
+        from app.archive import archive_posts
+        cutoff = datetime.utcnow() - parse_age(older_than)
+        moved = archive_posts(cutoff, batch_size=batch_size, unindex=unindex)
+        click.echo(f'Archived {moved} post(s) older than {cutoff:%Y-%m-%d %H:%M}')
+
+    @app.cli.group('timeline')
+    def timeline_group():
+        """Home feed timeline cache commands."""
+        pass
+
+    @timeline_group.command('rebuild')
+    def rebuild_timeline():
+        """Reload the cached timeline window from the database."""
+        from app import timeline
+        count = timeline.rebuild()
+        click.echo(f'Timeline rebuilt with {count} post(s)')
+
+    @app.cli.group()
+    def bench():
+        """Micro benchmarks."""
+        pass
+
+    @bench.command('login')
+    @click.option('--seconds', default=3.0, help='Duration of the benchmark.')
+    def bench_login(seconds):
+        """Password verifications (logins) per second on one core."""
+        from app.passwords import hash_method, hash_password, verify_password
+        password_hash = hash_password('benchmark-password')
+        count, start = 0, time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            verify_password(password_hash, 'benchmark-password')
+            count += 1
+        elapsed = time.perf_counter() - start
+        click.echo(f'{hash_method()}: {count / elapsed:.1f} logins/sec per core '
+                   f'({elapsed / count * 1000:.1f} ms per verification)')
+
+    @bench.command('timeline')
+    @click.option('--requests', default=200, help='Page renders per read path.')
+    @click.option('--per-page', type=int, help='Posts per page, POSTS_PER_PAGE by default.')
+    def bench_timeline(requests, per_page):
+        """Allocations and latency of a home feed page, ORM entities vs read models."""
+        import tracemalloc
+        from flask import render_template
+        from app import db, readmodels
+        from app.models import Post
+        per_page = per_page or app.config['POSTS_PER_PAGE']
+        newest = Post.query.order_by(Post.timestamp.desc())
+        paths = {
+            'orm': lambda: newest.limit(per_page).all(),
+            'read model': lambda: readmodels.load(
+                readmodels.select_posts(newest).limit(per_page)),
+        }
+
+        # one simulated request: load a page, render its posts, and end the
+        # session as the request teardown does
+        def render_page(load):
+            for post in load():
+                render_template('_post.html', post=post)
+            db.session.remove()
+
+        with app.test_request_context():
+            for name, load in paths.items():
+                render_page(load)
+                latencies = []
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    render_page(load)
+                    latencies.append(time.perf_counter() - start)
+                latencies.sort()
+                # allocations are traced in a separate pass, tracing slows
+                # down every allocation, a request allocates at least its
+                # peak traced memory above the memory in use before it
+                tracemalloc.start()
+                allocated = []
+                for _ in range(requests):
+                    tracemalloc.reset_peak()
+                    before = tracemalloc.get_traced_memory()[0]
+                    render_page(load)
+                    allocated.append(tracemalloc.get_traced_memory()[1] - before)
+                tracemalloc.stop()
+                click.echo(f'{name:<10} {per_page} posts/page: '
+                           f'p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, '
+                           f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f} ms, '
+                           f'peak allocations {sum(allocated) / requests / 1024:.1f} KiB/request')
+
+    @app.cli.group('bloom')
+    def bloom_group():
+        """Username and email bloom filter commands."""
+        pass
+
+    @bloom_group.command('rebuild')
+    def rebuild_bloom():
+        """Rebuild the bloom filter of taken usernames and emails."""
+        from app import bloom
+        count = bloom.rebuild()
+        click.echo(f'Bloom filter rebuilt with {count} user(s)')
@@ -0,0 +1,198 @@
+# asynchronous mail delivery
+#
+# send_email() never talks to the smtp server inside the request (or job)
+# that sends the email:
+# - each recipient gets one entry in the 'mail:outbox' sorted set, scored by
+#   the time the entry is due, and a deliver_mail job is enqueued on the
+#   MAIL_QUEUE rq queue, unless one is already waiting
+# - the job sends all due entries over one smtp connection, an entry is
+#   claimed (removed from the outbox) before it is sent, so concurrent jobs
+#   never send it twice
+# - temporary failures (4xx replies, dropped connections) put the entry back
+#   with an exponential backoff, until MAIL_MAX_ATTEMPTS, retries are run by
+#   jobs scheduled in the future, which needs `rq worker --with-scheduler`
+# - an email that cannot be sent at all (e.g. a bad header) is dropped alone
+# - when the connection drops (or the job breaks) only the email being sent
+#   counts a failed attempt, the claimed emails that were not tried yet go
+#   back to the outbox as they were, and the next job waits for the backoff
+# - a recipient gets the same email (same dedup key, by default the subject
+#   and body) at most once per MAIL_DEDUP_TTL seconds
+# - when redis is unavailable the email is sent synchronously as before
+#
+# the queue is drained by `rq worker microblog-mail`, see `app/tasks.py`
+
+import hashlib
+import json
+import smtplib
+import time
+import uuid
+from datetime import timedelta
+from flask import current_app
+from flask_mail import Message
+from redis.exceptions import RedisError
+from app import mail
+
+OUTBOX_KEY = 'mail:outbox'
+FLUSH_KEY = 'mail:flush:scheduled'
+RETRY_KEY = 'mail:flush:retry'
+SENT_KEY = 'mail:sent:{}:{}'
+
+
+def _message(entry):
+    return Message(entry['subject'], sender=entry['sender'],
+                   recipients=[entry['recipient']],
+                   body=entry['text_body'], html=entry['html_body'])
+
+
+def _dedup_key(subject, text_body, html_body):
+    content = '\0'.join([subject, text_body or '', html_body or ''])
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+# queue an email, returns the recipients it was queued for, i.e. without
+# those that got the same email within MAIL_DEDUP_TTL seconds
+def send_email(subject, recipients, text_body, html_body=None, sender=None,
+               dedup_key=None):
+    config = current_app.config
+    sender = sender or config['MAIL_DEFAULT_SENDER']
+    dedup_key = dedup_key or _dedup_key(subject, text_body, html_body)
+    redis = current_app.redis
+    try:
+        queued = []
+        pipe = redis.pipeline(transaction=False)
+        for recipient in recipients:
+            pipe.set(SENT_KEY.format(dedup_key, recipient.lower()), 1,
+                     nx=True, ex=config['MAIL_DEDUP_TTL'])
+        for recipient, first in zip(recipients, pipe.execute()):
+            if first:
+                queued.append(recipient)
+        if not queued:
+            return []
+        now = time.time()
+        redis.zadd(OUTBOX_KEY, {json.dumps({
+            'id': uuid.uuid4().hex, 'subject': subject, 'sender': sender,
+            'recipient': recipient, 'text_body': text_body, 'html_body': html_body,
+            'dedup_key': dedup_key, 'attempts': 0}): now for recipient in queued})
+        _schedule_delivery()
+        return queued
+    except RedisError as e:
+        current_app.logger.warning(f'Mail queue unavailable, sending synchronously: {e}')
+        mail.send(Message(subject, sender=sender, recipients=list(recipients),
+                          body=text_body, html=html_body))
+        return list(recipients)
+
+
+# enqueue a deliver_mail job unless one is waiting, retries are scheduled
+# `delay` seconds ahead and tracked apart, so that they do not hold back
+# new emails
+def _schedule_delivery(delay=0):
+    key = RETRY_KEY if delay else FLUSH_KEY
+    if not current_app.redis.set(key, 1, nx=True, ex=int(delay) + 600):
+        return
+    queue = current_app.mail_queue
+    if delay:
+        queue.enqueue_in(timedelta(seconds=delay), 'app.tasks.deliver_mail', True)
+    else:
+        queue.enqueue('app.tasks.deliver_mail')
+
+
+# claim up to `count` due entries, returns (entry, due time) tuples
+def _claim(count, now):
+    redis = current_app.redis
+    claimed = []
+    for member, due in redis.zrangebyscore(OUTBOX_KEY, '-inf', now, start=0, num=count,
+                                           withscores=True):
+        # another job may have claimed it meanwhile
+        if redis.zrem(OUTBOX_KEY, member):
+            claimed.append((json.loads(member), due))
+    return claimed
+
+
+# put claimed entries that were not tried back, unchanged
+def _release(claimed):
+    if claimed:
+        current_app.redis.zadd(OUTBOX_KEY, {json.dumps(entry): due for entry, due in claimed})
+
+
+# temporary failures are retried with a backoff, others dropped
+def _failed(entry, error, temporary):
+    config = current_app.config
+    entry['attempts'] += 1
+    if temporary and entry['attempts'] < config['MAIL_MAX_ATTEMPTS']:
+        delay = config['MAIL_RETRY_BACKOFF'] * 2 ** (entry['attempts'] - 1)
+        current_app.redis.zadd(OUTBOX_KEY, {json.dumps(entry): time.time() + delay})
+        current_app.logger.warning(f"Mail to {entry['recipient']} failed, "
+                                   f"retry in {delay}s: {error}")
+        return
+    # the email was never delivered, a later send_email may try again
+    current_app.redis.delete(SENT_KEY.format(entry['dedup_key'], entry['recipient'].lower()))
+    current_app.logger.error(f"Mail to {entry['recipient']} dropped after "
+                             f"{entry['attempts']} attempt(s): {error}")
+
+
+# dropped connections, timeouts, ... note that smtp errors are OSErrors too
+def _connection_lost(error):
+    return isinstance(error, smtplib.SMTPServerDisconnected) or \
+        not isinstance(error, smtplib.SMTPException)
+
+
+def _temporary(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return _connection_lost(error)
+
+
+# send all due entries over one smtp connection, returns the number sent
+# run by the deliver_mail job, see `app/tasks.py`
+def deliver(retry=False):
+    config = current_app.config
+    redis = current_app.redis
+    # emails queued from now on need another job
+    redis.delete(RETRY_KEY if retry else FLUSH_KEY)
+    sent = 0
+    lost = False
+    claimed = _claim(config['MAIL_BATCH_SIZE'], time.time())
+    if claimed:
+        # the entry being sent
+        entry = None
+        try:
+            with mail.connect() as connection:
+                while claimed:
+                    entry, _ = claimed.pop(0)
+                    try:
+                        connection.send(_message(entry))
+                        sent += 1
+                    except OSError as e:
+                        if _connection_lost(e):
+                            raise
+                        _failed(entry, e, _temporary(e))
+                    # the email itself is broken (e.g. a newline in the
+                    # subject), sending it again would fail the same way
+                    except Exception as e:
+                        _failed(entry, e, False)
+                    entry = None
+                    if not claimed:
+                        claimed = _claim(config['MAIL_BATCH_SIZE'], time.time())
+        except Exception as e:
+            # the connection is gone, or the job broke: the email being sent
+            # (the first one when no connection was made) counts the failure,
+            # the others go back to the outbox instead of being lost
+            if not isinstance(e, OSError):
+                current_app.logger.exception('Mail delivery failed')
+            lost = True
+            if entry is None and claimed:
+                entry, _ = claimed.pop(0)
+            if entry is not None:
+                _failed(entry, e, True)
+            _release(claimed)
+    # schedule the retries of failed entries, after a lost connection the
+    # entries that were not tried wait for the backoff too
+    due = redis.zrange(OUTBOX_KEY, 0, 0, withscores=True)
+    if due:
+        delay = due[0][1] - time.time()
+        if lost:
+            delay = max(delay, config['MAIL_RETRY_BACKOFF'])
+        _schedule_delivery(max(delay, 1) if delay > 0 else 0)
+    return sent
@@ -19,6 +19,13 @@ def not_found_error(error):
     return render_template('errors/404.html'), 404
 
 
+# rate limited requests, see `app/ratelimit.py`
+@bp.app_errorhandler(429)
+def too_many_requests_error(error):
+    return render_template('errors/429.html'), 429, \
+        {'Retry-After': str(error.retry_after or 1)}
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     # make sure to clear possibly dirty db session
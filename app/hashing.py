@@ -0,0 +1,12 @@
+# hashing for the probabilistic structures (bloom filter, count-min sketch)
+
+import hashlib
+
+
+# `count` positions of a value in [0, size), by double hashing one 128 bit
+# digest: position i is h1 + i * h2, with h2 odd
+def positions(value, count, size):
+    digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'big')
+    h2 = int.from_bytes(digest[8:], 'big') | 1
+    return [(h1 + i * h2) % size for i in range(count)]
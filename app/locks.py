@@ -0,0 +1,18 @@
+# locks shared by all processes, kept in redis
+
+from flask import current_app
+
+
+# run `rebuild` in one process (or thread) at a time: returns False right
+# away when another one holds the `key` lock, callers then carry on without
+# the rebuilt data (e.g. read the database) meanwhile. the lock expires
+# after `timeout` seconds in case its holder dies
+def rebuild_once(key, rebuild, timeout):
+    redis = current_app.redis
+    if not redis.set(key, 1, nx=True, ex=timeout):
+        return False
+    try:
+        rebuild()
+    finally:
+        redis.delete(key)
+    return True
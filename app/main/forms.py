@@ -4,6 +4,7 @@ from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextA
 from wtforms.validators import ValidationError
 from wtforms.validators import DataRequired
 from wtforms.validators import Length
+from app import bloom
 from app.models import User
 
 
@@ -48,7 +49,8 @@ class EditProfileForm(FlaskForm):
         self.original_username = original_username
 
     def validate_username(self, username):
-        if username != self.original_username:
+        if username.data != self.original_username and \
+                bloom.might_exist('username', username.data):
             user = User.query.filter_by(username=username.data).first()
             if user is not None:
                 raise ValidationError('Username already taken, please use a different username')
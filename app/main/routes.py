@@ -3,13 +3,23 @@ from flask import render_template, flash, redirect, url_for
 from flask import request
 from flask import g
 from flask import current_app
+from flask import abort, jsonify
 from flask_login import current_user
 from flask_login import login_required
+from flask_sqlalchemy import Pagination
+from sqlalchemy.exc import IntegrityError
 from app import db
-from app.models import User, Post
+from app import archive
+from app import postsearch
+from app import readmodels
+from app import metrics
+from app import timeline
+from app import trending as trending_terms
+from app.models import User, Post, Counter
 from app.main.forms import EditProfileForm, PostForm
 from app.main.forms import SearchForm
 from app.main import bp
+from app.ratelimit import rate_limit
 
 
 # before request interceptor
@@ -26,9 +36,40 @@ def before_request():
         # Note that g context is request scope, so every incoming request
         # has a new SearchForm object that can be referred in different
         # view templates.
-        # Only initialize SearchForm when elasticsearch is enabled
-        if current_app.elasticsearch is not None:
-            g.search_form = SearchForm()
+        # Search works without elasticsearch too, it falls back to the
+        # database, see `app/postsearch.py`
+        g.search_form = SearchForm()
+
+
+# paginate a query with a known total, such as a denormalized counter,
+# BaseQuery.paginate() would run an extra COUNT(*) query for it
+def _paginate(query, page, per_page, total):
+    page = max(page, 1)
+    rows = readmodels.select_posts(query).limit(per_page).offset((page - 1) * per_page)
+    return Pagination(query, page, per_page, total, readmodels.load(rows))
+
+
+# in-process runtime metrics (connection pools, ...) of the worker serving
+# this request, only exposed when METRICS_ENABLED is set
+@bp.route('/metrics')
+def runtime_metrics():
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    return jsonify(metrics.snapshot())
+
+
+# trending terms of recent posts as json, served from fixed size counters,
+# see `app/trending.py`
+@bp.route('/trending')
+@login_required
+def trending():
+    limit = max(1, min(request.args.get('limit', 10, type=int),
+                       current_app.config['TRENDING_TOP_K']))
+    return jsonify({
+        'window': current_app.config['TRENDING_WINDOW'],
+        'terms': [{'term': term, 'score': round(score, 3)}
+                  for term, score in trending_terms.trending(limit)],
+    })
 
 
 @bp.route('/export_posts')
@@ -44,6 +85,7 @@ def export_posts():
 
 @bp.route('/search')
 @login_required
+@rate_limit('search')
 def search():
     # use form.validate() which just validates field values, without checking
     # how the data was submitted
@@ -52,7 +94,8 @@ def search():
         return redirect(url_for('main.index'))
     page = request.args.get('page', 1, type=int)
     page_size = current_app.config.get('POSTS_PER_PAGE', 3)
-    posts, total = Post.search(g.search_form.q.data, page, page_size)
+    # elasticsearch with timeouts, or the database when it misbehaves
+    posts, total = postsearch.search_posts(g.search_form.q.data, page, page_size)
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * page_size else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
@@ -64,6 +107,7 @@ def search():
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@rate_limit('post', methods=['POST'])
 def index():
     form = PostForm()
     if form.validate_on_submit():
@@ -74,10 +118,15 @@ def index():
         return redirect(url_for('main.index'))
 
     # basic pagination,
+    # recent pages are served from the redis timeline cache, the database is
+    # only used for pages beyond the cached window, see `app/timeline.py`
     page = request.args.get('page', 1, type=int)
     page_size = current_app.config.get('POSTS_PER_PAGE', 3)
-    posts_pg = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, page_size, False)
+    posts_pg = timeline.page(page, page_size)
+    if posts_pg is None:
+        posts_pg = _paginate(Post.query.order_by(Post.timestamp.desc()),
+                             page, page_size,
+                             Counter.get('posts') - Counter.get('archived_posts'))
 
     prev_pg_url = url_for('main.index', page=posts_pg.prev_num) if posts_pg.has_prev else None
     next_pg_url = url_for('main.index', page=posts_pg.next_num) if posts_pg.has_next else None
@@ -96,12 +145,12 @@ def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
     page_size = current_app.config.get('POSTS_PER_PAGE', 3)
-    posts_pg = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, page_size, False)
+    # reads through to the archive past the user's hot posts
+    posts_pg = archive.user_posts(user, page, page_size, user.post_count)
 
-    prev_pg_url = url_for('user', username=username,
+    prev_pg_url = url_for('main.user', username=username,
                           page=posts_pg.prev_num) if posts_pg.has_prev else None
-    next_pg_url = url_for('user', username=username,
+    next_pg_url = url_for('main.user', username=username,
                           page=posts_pg.next_num) if posts_pg.has_next else None
 
     return render_template('user.html', user=user, posts=posts_pg.items,
@@ -115,7 +164,13 @@ def edit_profile():
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()  # current_user is already in db.session
+        try:
+            db.session.commit()  # current_user is already in db.session
+        except IntegrityError:
+            # the unique index has the final word on taken usernames
+            db.session.rollback()
+            flash('Username already taken, please use a different username')
+            return render_template('edit_profile.html', title='Edit Profile', form=form)
         flash('Your profile has been saved')
         return redirect(url_for('main.edit_profile'))
 
@@ -0,0 +1,124 @@
+# in-process runtime metrics
+#
+# metrics are kept per python process (per gunicorn worker), and exposed as
+# json by the `/metrics` route when METRICS_ENABLED is set, see
+# `app/main/routes.py`
+
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('app.metrics')
+
+_lock = threading.Lock()
+_pools = {}
+_timings = {}
+
+
+# connection pool telemetry: checkout wait time, in-use count and timeouts
+class PoolStats(object):
+    def __init__(self, name):
+        self.name = name
+        # max connections the pool hands out, and the checkout wait time
+        # (seconds) after which an exhaustion warning is logged
+        self.size = None
+        self.warn_after = None
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, size, warn_after):
+        self.size = size
+        self.warn_after = warn_after
+
+    def record_checkout(self, wait, in_use=None):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use = self.in_use + 1 if in_use is None else in_use
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        if self.warn_after is not None and wait >= self.warn_after:
+            logger.warning(f'{self.name} pool exhausted: waited {wait:.3f}s for a '
+                           f'connection ({self.in_use}/{self.size} in use)')
+
+    def record_checkin(self, in_use=None):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0) if in_use is None else in_use
+
+    def record_timeout(self, wait):
+        with self._lock:
+            self.timeouts += 1
+        logger.warning(f'{self.name} pool exhausted: checkout timed out after '
+                       f'{wait:.3f}s ({self.in_use}/{self.size} in use)')
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'checkouts': self.checkouts,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'timeouts': self.timeouts,
+                'wait_avg': self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_max': self.wait_max,
+            }
+
+
+# get (or create) the process wide stats of a named pool
+def pool_stats(name):
+    with _lock:
+        if name not in _pools:
+            _pools[name] = PoolStats(name)
+        return _pools[name]
+
+
+# call count and duration of an operation, e.g. the overhead of a
+# rate limit check, the p95 is taken over the most recent calls
+class TimingStats(object):
+    recent = 1000
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=self.recent)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self._recent.append(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            recent = sorted(self._recent)
+            return {
+                'count': self.count,
+                'avg': self.total / self.count if self.count else 0.0,
+                'p95': recent[int(len(recent) * 0.95)] if recent else 0.0,
+                'max': self.max,
+            }
+
+
+def timing_stats(name):
+    with _lock:
+        if name not in _timings:
+            _timings[name] = TimingStats(name)
+        return _timings[name]
+
+
+def snapshot():
+    with _lock:
+        pools, timings = dict(_pools), dict(_timings)
+    return {
+        'pools': {name: stats.snapshot() for name, stats in pools.items()},
+        'timings': {name: stats.snapshot() for name, stats in timings.items()},
+    }
@@ -1,71 +1,66 @@
-from datetime import datetime
+import secrets
+from datetime import datetime, timedelta
 from hashlib import md5
 from flask_login import UserMixin
-from flask import current_app
-from werkzeug.security import generate_password_hash, check_password_hash
+from redis.exceptions import RedisError
+from flask import current_app, url_for
 from app import db
 from app import login
+from app.passwords import hash_password, verify_password, needs_rehash, \
+    PasswordHashBusy
 
 # Elasticsearch #
 #
 # define a searchable model mixin for elasticsearch functions driven
 # by sqlalchemy events
-from app.search import query_index, add_to_index, remove_from_index
+from app.search import add_to_index, add_many_to_index, remove_ids_from_index
 
 
 # implementation design:
 # - all indexes will be named with the name Flask-SQLAlchemy assigned to the
 #   relational table
-# - sqlalchemy take ES returned ids list to query db to get entity objects
-# - in sql query, ensure objects are ordered with same ordering of ES returned
-#   ids list, because this ordering reflects ES match scores
-# - the elasticsearch specific search impl is external and loaded as a module,
+# - the elasticsearch specific index impl is external and loaded as a module,
 #   so that searching logic and data layer logic are decoupled
+# - searching is done by `app/postsearch.py`, with timeouts and a database
+#   fallback
 class SearchableMixin(object):
-    @classmethod
-    def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression,
-                                 page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-
-        # query database by ids list, with case-when sorting
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
-
-    # register all session transactional entities into session hash so that
-    # after session commit the Elasticsearch search module can update index
-    # accordingly,
+    # snapshot the searchable fields of the entities of each flush into the
+    # session, so that after session commit the Elasticsearch search module
+    # can update index accordingly,
     # this is because after session commit, the objects that are marked
-    # 'new', 'dirty', and 'deleted' will all be gone
+    # 'new', 'dirty', and 'deleted' will all be gone, and reading the fields
+    # of expired objects would reload each row with its own SELECT
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def after_flush(cls, session, flush_context):
+        changes = session.info.setdefault('search_changes', {'add': {}, 'delete': {}})
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, SearchableMixin):
+                changes['add'].setdefault(obj.__tablename__, {})[obj.id] = {
+                    field: getattr(obj, field) for field in obj.__searchable__}
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                changes['add'].get(obj.__tablename__, {}).pop(obj.id, None)
+                changes['delete'].setdefault(obj.__tablename__, set()).add(obj.id)
 
     # after_commit event is only triggered after a session commit is successful,
     # this means that ES indexing only happens after a successful session
     # commit.
+    # added, updated and deleted documents go to the index in one bulk
+    # request each per index, so that a batch of posts committed together
+    # costs one request
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        # use same function for update
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        # clear session _changes hash
-        session._changes = None
+        changes = session.info.pop('search_changes', None)
+        if not changes:
+            return
+        for index, documents in changes['add'].items():
+            add_many_to_index(index, documents)
+        for index, ids in changes['delete'].items():
+            remove_ids_from_index(index, list(ids))
+
+    @classmethod
+    def after_soft_rollback(cls, session, previous_transaction):
+        session.info.pop('search_changes', None)
 
     # a helper method to refresh an index for all the data rows of an entity
     @classmethod
@@ -76,18 +71,21 @@ class SearchableMixin(object):
 
 
 # register sqlalchemy event handlers
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', SearchableMixin.after_soft_rollback)
 
 # Redis task queue #
 #
-import redis
-import rq
-
-
 # Task model has many-to-one FK to User model
 #
 class Task(db.Model):
+    # covers the in-progress lookups by user, task name and completion, see
+    # User.get_tasks_in_progress() and User.get_task_in_progress()
+    __table_args__ = (
+        db.Index('ix_task_user_id_name_complete', 'user_id', 'name', 'complete'),
+    )
+
     id = db.Column(db.String(36), primary_key=True)
     name = db.Column(db.String(128), index=True)
     description = db.Column(db.String(128))
@@ -95,9 +93,11 @@ class Task(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
     def get_rq_job(self):
+        # rq is imported on first use to keep app startup fast
+        import rq
         try:
             rq_job = rq.job.Job.fetch(self.id, current_app.redis)
-        except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
+        except (RedisError, rq.exceptions.NoSuchJobError):
             return None
         return rq_job
 
@@ -106,6 +106,19 @@ class Task(db.Model):
         return job.meta.get('progress', 0) if job is not None else 100
 
 
+# gravatar identifies avatars by the md5 digest of the lower case email
+def email_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+# avatar image of an email digest, a local identicon when LOCAL_AVATARS is
+# set, see `app/avatars/`, or the gravatar identicon otherwise
+def avatar_url(digest, size=64):
+    if current_app.config['LOCAL_AVATARS']:
+        return url_for('avatars.identicon', digest=digest, size=size)
+    return f"https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}"
+
+
 # flask-login extension provides UserMixin that includes four methods:
 # - is_authenticated
 # - is_active
@@ -123,19 +136,65 @@ class User(UserMixin, db.Model):
     # will detect this change and generate migration script accordingly
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow())
+    # denormalized number of posts, maintained by Post insert/delete events
+    # so that it can be read without a COUNT(*) over user.posts
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # email_digest() of the email, kept up to date by the email validator so
+    # that pages do not hash the email of every post author
+    avatar_digest = db.Column(db.String(32))
+    # api bearer token and its expiration, see `app/api/auth.py`
+    token = db.Column(db.String(32), index=True, unique=True)
+    token_expiration = db.Column(db.DateTime)
     # has many tasks
     tasks = db.relationship('Task', backref='user', lazy='dynamic')
+    # old posts moved out of the post table, see `app/archive.py`
+    archived_posts = db.relationship('PostArchive', backref='author', lazy='dynamic')
 
+    # hash parameters are set by Config, see `app/passwords.py`
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
+    # a hash made with outdated parameters is replaced on success, the
+    # caller commits the session to store it, when all hashing slots are
+    # busy the rehash is left to the next login
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not verify_password(self.password_hash, password):
+            return False
+        if needs_rehash(self.password_hash):
+            try:
+                self.set_password(password)
+            except PasswordHashBusy:
+                pass
+        return True
+
+    # a token that is still valid for at least a minute is reused, the
+    # caller commits the session to store a new one
+    def get_token(self, expires_in=3600):
+        now = datetime.utcnow()
+        if self.token and self.token_expiration > now + timedelta(seconds=60):
+            return self.token
+        self.token = secrets.token_hex(16)
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        return self.token
+
+    def revoke_token(self):
+        self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+
+    @staticmethod
+    def check_token(token):
+        user = User.query.filter_by(token=token).first()
+        if user is None or user.token_expiration < datetime.utcnow():
+            return None
+        return user
+
+    @db.validates('email')
+    def _set_avatar_digest(self, key, email):
+        self.avatar_digest = email_digest(email) if email else None
+        return email
 
     # generate avatar icon url
     def avatar(self, size=64):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f"https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}"
+        return avatar_url(self.avatar_digest or email_digest(self.email), size)
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
@@ -161,6 +220,27 @@ class User(UserMixin, db.Model):
         return Task.query.filter_by(user=self, name=name, complete=False).first()
 
 
+# keep the bloom filter of taken usernames and emails up to date, see
+# `app/bloom.py`
+# values are added at flush time, a rolled back insert only leaves a
+# harmless false positive behind
+@db.event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    from app import bloom
+    bloom.add('username', target.username)
+    bloom.add('email', target.email)
+
+
+@db.event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    from app import bloom
+    state = db.inspect(target)
+    if state.attrs.username.history.has_changes():
+        bloom.add('username', target.username)
+    if state.attrs.email.history.has_changes():
+        bloom.add('email', target.email)
+
+
 # flask-login extension does not know how to fetch user data
 # flask-login delegates user data access to this function
 @login.user_loader
@@ -171,6 +251,11 @@ def load_user(id):
 class Post(SearchableMixin, db.Model):
     # define a class attribute to include all ES indexed fields
     __searchable__ = ['body']
+    # covers the user timeline, user.posts ordered by timestamp, so that it
+    # is read in index order without a sort
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
@@ -179,3 +264,153 @@ class Post(SearchableMixin, db.Model):
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+
+# cold storage for old posts, rows are moved here from the post table by
+# `flask posts archive` and keep their post id, see `app/archive.py`
+class PostArchive(db.Model):
+    __tablename__ = 'post_archive'
+    __table_args__ = (
+        db.Index('ix_post_archive_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<PostArchive {}>'.format(self.body)
+
+
+# named global counters, such as the total number of posts
+class Counter(db.Model):
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def get(cls, name):
+        counter = cls.query.get(name)
+        return counter.value if counter is not None else 0
+
+    def __repr__(self):
+        return '<Counter {}={}>'.format(self.name, self.value)
+
+
+# Denormalized post counters #
+#
+# User.post_count and the global 'posts' counter are maintained by an
+# after_flush hook from the posts inserted and deleted in the flush, summed
+# per user, so that a batch of posts costs one UPDATE per author and one of
+# the shared counter row, not two per post. The updates are issued on the
+# flush connection, so they commit or roll back together with the post rows.
+# Note that counters are updated in the database only, loaded User objects
+# pick up the new value once expired, which happens on session commit.
+# Posts removed with bulk (non-ORM) deletes bypass these events, use
+# `flask counters rebuild` to repair the counters after such changes.
+# Archived posts still count, the archive job moves them with bulk
+# statements and only adds them to the 'archived_posts' counter.
+def _update_post_counters(session, flush_context):
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Post):
+            deltas[obj.user_id] = deltas.get(obj.user_id, 0) + 1
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            deltas[obj.user_id] = deltas.get(obj.user_id, 0) - 1
+    total = sum(deltas.values())
+    if not any(deltas.values()):
+        return
+    connection = session.connection()
+    users = User.__table__
+    # rows are locked in id order, so that concurrent flushes do not deadlock
+    for user_id in sorted(user_id for user_id in deltas if user_id is not None):
+        if deltas[user_id]:
+            connection.execute(users.update().where(users.c.id == user_id).values(
+                post_count=users.c.post_count + deltas[user_id]))
+    if not total:
+        return
+    counters = Counter.__table__
+    result = connection.execute(counters.update().where(
+        counters.c.name == 'posts').values(value=counters.c.value + total))
+    if result.rowcount == 0:
+        connection.execute(counters.insert().values(name='posts', value=max(total, 0)))
+
+
+db.event.listen(db.session, 'after_flush', _update_post_counters)
+
+
+# Read cache change feed #
+#
+# posts and users changed in a flush are snapshot in an after_flush hook,
+# while ids are assigned and the attribute history is still available, and
+# are published to the redis read caches (see `app/timeline.py`) and the
+# trending terms tracker (see `app/trending.py`) only after the transaction
+# commits. A rollback discards them.
+def _collect_cache_changes(session, flush_context):
+    changes = session.info.setdefault('cache_changes', {
+        'posts': [], 'new_posts': [], 'deleted_posts': [], 'authors': set()})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Post):
+            snapshot = {'id': obj.id, 'body': obj.body,
+                        'timestamp': obj.timestamp, 'user_id': obj.user_id}
+            changes['posts'].append(snapshot)
+            if obj in session.new:
+                changes['new_posts'].append(snapshot)
+        # only username and email are cached, last_seen updates on every
+        # request must not drop the author card
+        elif isinstance(obj, User) and obj in session.dirty:
+            state = db.inspect(obj)
+            if state.attrs.username.history.has_changes() or \
+                    state.attrs.email.history.has_changes():
+                changes['authors'].add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            changes['deleted_posts'].append(obj.id)
+
+
+def _publish_cache_changes(session):
+    changes = session.info.pop('cache_changes', None)
+    if not changes:
+        return
+    from app import timeline, trending
+    timeline.add_posts(changes['posts'])
+    trending.add_posts(changes['new_posts'])
+    timeline.remove_posts(changes['deleted_posts'])
+    timeline.invalidate_authors(list(changes['authors']))
+
+
+def _discard_cache_changes(session, previous_transaction=None):
+    session.info.pop('cache_changes', None)
+
+
+db.event.listen(db.session, 'after_flush', _collect_cache_changes)
+db.event.listen(db.session, 'after_commit', _publish_cache_changes)
+db.event.listen(db.session, 'after_soft_rollback', _discard_cache_changes)
+
+
+# recompute all post counters from the post and post_archive tables
+# returns the number of counters that had drifted
+def rebuild_post_counters():
+    users, posts, archive = User.__table__, Post.__table__, PostArchive.__table__
+    actual = db.select([db.func.count(posts.c.id)]).where(
+        posts.c.user_id == users.c.id).scalar_subquery() + \
+        db.select([db.func.count(archive.c.id)]).where(
+            archive.c.user_id == users.c.id).scalar_subquery()
+    drifted = db.session.execute(db.select([db.func.count(users.c.id)]).where(
+        users.c.post_count != actual)).scalar()
+    db.session.execute(users.update().values(post_count=actual))
+
+    archived = db.session.execute(db.select([db.func.count(archive.c.id)])).scalar()
+    hot = db.session.execute(db.select([db.func.count(posts.c.id)])).scalar()
+    for name, total in (('posts', hot + archived), ('archived_posts', archived)):
+        if Counter.get(name) != total:
+            drifted += 1
+        counter = Counter.query.get(name)
+        if counter is None:
+            db.session.add(Counter(name=name, value=total))
+        else:
+            counter.value = total
+    db.session.commit()
+    return drifted
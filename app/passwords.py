@@ -0,0 +1,74 @@
+# password hashing with configurable cost
+#
+# hash method, work factor and salt length come from Config, hashes stored
+# with other parameters are upgraded on the next successful login, see
+# User.check_password()
+#
+# hashing is cpu bound by design, computations run in a small per-process
+# thread pool, and callers wait at most PASSWORD_HASH_TIMEOUT seconds for a
+# free slot, so that a flood of logins cannot take every worker thread
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+# raised when no hashing slot frees up in time
+class PasswordHashBusy(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_pool = None
+
+
+# the pool is created on first use and per process id, so that gunicorn
+# workers forked from a preloaded app do not share a pool without threads
+def _get_pool():
+    global _pool
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    with _lock:
+        if _pool is None or _pool[0] != os.getpid():
+            _pool = (os.getpid(), ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='password-hash'),
+                threading.BoundedSemaphore(workers))
+        return _pool[1], _pool[2]
+
+
+def _run(func, *args, **kwargs):
+    executor, slots = _get_pool()
+    if not slots.acquire(timeout=current_app.config['PASSWORD_HASH_TIMEOUT']):
+        raise PasswordHashBusy('Too many password hash computations in progress')
+    try:
+        return executor.submit(func, *args, **kwargs).result()
+    finally:
+        slots.release()
+
+
+# werkzeug method string for the configured hash parameters, as stored in
+# front of the salt, e.g. pbkdf2:sha256:260000
+def hash_method():
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    if method.startswith('pbkdf2'):
+        method = f"{method}:{current_app.config['PASSWORD_HASH_ITERATIONS']}"
+    return method
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, method=hash_method(),
+                salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+# check if a stored hash was made with outdated parameters
+def needs_rehash(password_hash):
+    if password_hash.count('$') < 2:
+        return True
+    method, salt, _ = password_hash.split('$', 2)
+    return method != hash_method() or \
+        len(salt) != current_app.config['PASSWORD_SALT_LENGTH']
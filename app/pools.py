@@ -0,0 +1,103 @@
+# instrumented connection pools for the database and redis
+# pool sizes are set by Config, and pool telemetry is recorded into
+# `app/metrics.py` PoolStats
+
+import time
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+from app import metrics
+
+
+# sqlalchemy QueuePool that records checkout wait time, in-use count and
+# checkout timeouts
+# note that QueuePool.recreate() builds a new pool with the original
+# constructor arguments only, so the stats are looked up by name instead of
+# being passed in
+class InstrumentedQueuePool(QueuePool):
+    stats_name = 'db'
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self.stats = metrics.pool_stats(self.stats_name)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            rec = super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.stats.record_timeout(time.perf_counter() - start)
+            raise
+        self.stats.record_checkout(time.perf_counter() - start, self.checkedout())
+        return rec
+
+    def _do_return_conn(self, conn):
+        super(InstrumentedQueuePool, self)._do_return_conn(conn)
+        self.stats.record_checkin(self.checkedout())
+
+
+# sqlalchemy engine options from the DB_POOL_* config settings
+# sqlite has no use for a connection queue (flask-sqlalchemy hooks in a
+# static or null pool for it), so only pre-ping is applied there
+def engine_options(config):
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return options
+    metrics.pool_stats(InstrumentedQueuePool.stats_name).configure(
+        config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW'],
+        config['POOL_WAIT_WARNING'])
+    options.update({
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    })
+    return options
+
+
+# wrapper around a redis BlockingConnectionPool that records the same
+# telemetry, the blocking pool waits up to `timeout` seconds for a free
+# connection instead of failing straight away with "Too many connections"
+# it delegates everything else to the wrapped pool, which is only created
+# with the redis client on first use (`redis.exceptions` itself is already
+# imported at startup by the modules that catch `RedisError`)
+class InstrumentedRedisPool(object):
+    def __init__(self, pool, stats):
+        self._pool = pool
+        self.stats = stats
+
+    def get_connection(self, command_name, *keys, **options):
+        from redis.exceptions import ConnectionError
+        start = time.perf_counter()
+        try:
+            connection = self._pool.get_connection(command_name, *keys, **options)
+        except ConnectionError:
+            # connection errors are also raised when redis is down, only
+            # count the ones that waited out the pool timeout
+            wait = time.perf_counter() - start
+            if wait >= self._pool.timeout:
+                self.stats.record_timeout(wait)
+            raise
+        self.stats.record_checkout(time.perf_counter() - start)
+        return connection
+
+    def release(self, connection):
+        self._pool.release(connection)
+        self.stats.record_checkin()
+
+    def __getattr__(self, item):
+        return getattr(self._pool, item)
+
+    def __repr__(self):
+        return f'<InstrumentedRedisPool {self._pool!r}>'
+
+
+def redis_connection_pool(config):
+    from redis import BlockingConnectionPool
+    pool = BlockingConnectionPool.from_url(
+        config['REDIS_URL'],
+        max_connections=config['REDIS_MAX_CONNECTIONS'],
+        timeout=config['REDIS_POOL_TIMEOUT'])
+    stats = metrics.pool_stats('redis')
+    stats.configure(config['REDIS_MAX_CONNECTIONS'], config['POOL_WAIT_WARNING'])
+    return InstrumentedRedisPool(pool, stats)
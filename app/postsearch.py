@@ -0,0 +1,153 @@
+# post search with bounded latency
+#
+# the search and the total count are two elasticsearch calls run
+# concurrently in a small per-process thread pool, on the pooled client of
+# `app/services.py`, both under SEARCH_TIMEOUT seconds. a slow or failing
+# elasticsearch degrades to a database LIKE search instead of holding the
+# worker:
+# - timeouts, connection errors and elasticsearch error replies fall back to
+#   the database search, other errors (bugs) are raised
+# - after SEARCH_BREAKER_FAILURES failures in a row the circuit breaker opens
+#   and searches go to the database right away, after SEARCH_BREAKER_RESET
+#   seconds one search tries elasticsearch again, and closes the breaker on
+#   success
+# - the database count stops at SEARCH_FALLBACK_MAX_RESULTS matches, so that
+#   a common term does not count the whole post table
+
+import os
+import threading
+import time
+from concurrent import futures
+from flask import current_app
+from app import db, metrics, readmodels
+from app.models import Post
+
+
+class CircuitBreaker(object):
+    def __init__(self, failures, reset_after):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.failed = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    # False while the breaker is open, once reset_after seconds passed one
+    # trial call is let through per period
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_after:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failed = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failed += 1
+            if self.failed >= self.failures:
+                self.opened_at = time.monotonic()
+
+
+_lock = threading.Lock()
+_pool = None
+
+
+# the pool is created on first use and per process id, as in
+# `app/passwords.py`
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None or _pool[0] != os.getpid():
+            _pool = (os.getpid(), futures.ThreadPoolExecutor(
+                max_workers=current_app.config['SEARCH_WORKERS'],
+                thread_name_prefix='search'))
+        return _pool[1]
+
+
+# errors that mean elasticsearch is unavailable, imported on use, see
+# `app/services.py`
+def _unavailable_errors():
+    from elasticsearch import ApiError, TransportError
+    return futures.TimeoutError, ApiError, TransportError
+
+
+def _breaker():
+    if 'search_breaker' not in current_app.extensions:
+        current_app.extensions['search_breaker'] = CircuitBreaker(
+            current_app.config['SEARCH_BREAKER_FAILURES'],
+            current_app.config['SEARCH_BREAKER_RESET'])
+    return current_app.extensions['search_breaker']
+
+
+# ids of a page of matches and the total
+def _query_index(index, expression, page, per_page):
+    timeout = current_app.config['SEARCH_TIMEOUT']
+    query = {'multi_match': {'query': expression, 'fields': ['*']}}
+    # the client is thread safe, calls share its connection pool
+    client = current_app.elasticsearch.options(request_timeout=timeout)
+    executor = _get_pool()
+    deadline = time.monotonic() + timeout
+    calls = [executor.submit(client.search, index=index, query=query,
+                             from_=(page - 1) * per_page, size=per_page,
+                             track_total_hits=False),
+             executor.submit(client.count, index=index, query=query)]
+    try:
+        hits, count = [call.result(max(0.0, deadline - time.monotonic())) for call in calls]
+    finally:
+        # calls still queued behind other searches are not sent at all
+        for call in calls:
+            call.cancel()
+    return [int(hit['_id']) for hit in hits['hits']['hits']], count['count']
+
+
+# ids and total from elasticsearch, or None when the database has to be
+# searched instead
+def _search_index(expression, page, per_page):
+    breaker = _breaker()
+    if current_app.elasticsearch is None or not breaker.allow():
+        return None
+    try:
+        result = _query_index(Post.__tablename__, expression, page, per_page)
+    except _unavailable_errors() as e:
+        breaker.record_failure()
+        current_app.logger.warning(f'Search falls back to the database: {e!r}')
+        return None
+    breaker.record_success()
+    return result
+
+
+def _search_database(expression, page, per_page):
+    matches = Post.query.filter(Post.body.contains(expression, autoescape=True))
+    posts = readmodels.load(readmodels.select_posts(
+        matches.order_by(Post.timestamp.desc(), Post.id.desc()))
+        .offset((page - 1) * per_page).limit(per_page))
+    capped = matches.with_entities(Post.id).limit(
+        current_app.config['SEARCH_FALLBACK_MAX_RESULTS']).subquery()
+    total = db.session.query(db.func.count()).select_from(capped).scalar()
+    return posts, total
+
+
+# a page of posts matching the expression as read models, and the total
+def search_posts(expression, page, per_page):
+    start = time.perf_counter()
+    result = _search_index(expression, page, per_page)
+    if result is None:
+        posts, total = _search_database(expression, page, per_page)
+        metrics.timing_stats('search.database').record(time.perf_counter() - start)
+        return posts, total
+    ids, total = result
+    posts = {post.id: post for post in readmodels.load(readmodels.select_posts(
+        Post.query.filter(Post.id.in_(ids))))} if ids else {}
+    metrics.timing_stats('search.elasticsearch').record(time.perf_counter() - start)
+    # keep the relevance order, posts deleted since they were indexed are skipped
+    return [posts[id] for id in ids if id in posts], total
@@ -0,0 +1,154 @@
+# token bucket rate limiting for expensive routes
+#
+# requires setup:
+# - RATELIMITS config, (capacity, refill tokens per second) by limit name
+# - redis at current_app.redis, the in-process buckets are used when redis
+#   is unavailable or RATELIMIT_STORAGE is 'memory'
+#
+# usage, below @login_required so that the limit is kept per user:
+#
+#   @bp.route('/search')
+#   @login_required
+#   @rate_limit('search')
+#   def search(): ...
+#
+# a request over the limit is aborted with 429 Too Many Requests and a
+# Retry-After header, see `app/errors/handlers.py`
+#
+# a request takes one token, views that do more work per request (e.g. a
+# batch of posts) call check() with a cost once they know it
+
+import math
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from flask_login import current_user
+from redis.exceptions import RedisError
+from werkzeug.exceptions import TooManyRequests
+from app import metrics
+
+# refill and take `cost` tokens in a single atomic step
+# returns {allowed, retry_after}, retry_after as a string since lua numbers
+# are truncated to integers in redis replies
+_TOKEN_BUCKET_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+'''
+
+_KEY = 'ratelimit:{}:{}'
+
+
+# in-process token buckets, per python process
+class MemoryBuckets(object):
+    # drop refilled buckets once this many are kept
+    max_buckets = 10000
+
+    def __init__(self):
+        # key -> (tokens, last update, time the bucket is full again)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now, cost=1):
+        with self._lock:
+            tokens, ts, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                allowed, retry_after = True, 0.0
+            else:
+                allowed, retry_after = False, (cost - tokens) / rate
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                                 if bucket[2] > now}
+        return allowed, retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+memory_buckets = MemoryBuckets()
+
+
+_script = None
+
+
+def _redis_take(key, capacity, rate, now, cost=1):
+    global _script
+    redis = current_app.redis
+    # the registered script keeps its sha for EVALSHA, and loads the script
+    # into redis again when it is missing
+    if _script is None:
+        _script = redis.register_script(_TOKEN_BUCKET_SCRIPT)
+    allowed, retry_after = _script(keys=[key], args=[capacity, rate, now, cost],
+                                  client=redis)
+    return bool(allowed), float(retry_after)
+
+
+# the client a limit is kept for, the user when logged in, or the client ip
+def _client_key(by):
+    if callable(by):
+        return by()
+    if by != 'ip' and current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    return f'ip:{request.remote_addr}'
+
+
+# take `cost` tokens from the named bucket of the current client
+# returns (allowed, retry_after seconds)
+def take(name, by=None, cost=1):
+    capacity, rate = current_app.config['RATELIMITS'][name]
+    key = _KEY.format(name, _client_key(by))
+    now = time.time()
+    start = time.perf_counter()
+    try:
+        if current_app.config['RATELIMIT_STORAGE'] == 'redis':
+            try:
+                return _redis_take(key, capacity, rate, now, cost)
+            except RedisError as e:
+                current_app.logger.warning(f'Rate limit falls back to memory: {e}')
+        return memory_buckets.take(key, capacity, rate, now, cost)
+    finally:
+        metrics.timing_stats('ratelimit').record(time.perf_counter() - start)
+
+
+# abort the request with 429 when the current client is over the limit
+# `by` is 'ip' to limit by client ip even for logged in users, or a function
+# returning the client key, e.g. for users authenticated by api tokens
+def check(name, by=None, cost=1):
+    if not current_app.config['ENABLE_RATELIMIT']:
+        return
+    allowed, retry_after = take(name, by, cost)
+    if not allowed:
+        raise TooManyRequests(retry_after=math.ceil(retry_after))
+
+
+# view decorator, limits the given http methods only, or all methods
+def rate_limit(name, methods=None, by=None):
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if methods is None or request.method in methods:
+                check(name, by)
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
@@ -0,0 +1,64 @@
+# lightweight read models for rendering posts
+#
+# `_post.html` reads a few attributes of a post and its author, loading full
+# Post and User entities for that pays for the identity map, change tracking
+# and lazy loading of every row. pages of posts are instead read as plain
+# column tuples (post columns joined with the author columns, including the
+# stored avatar digest) and wrapped in small __slots__ objects
+#
+# usage, on any query of Post (or PostArchive) entities:
+#
+#   query = Post.query.order_by(Post.timestamp.desc())
+#   posts = readmodels.load(readmodels.select_posts(query).limit(per_page))
+#
+# `flask bench timeline` compares allocations and latency with the ORM path
+
+from app.models import User, Post, avatar_url
+
+
+class AuthorView(object):
+    __slots__ = ('id', 'username', 'avatar_digest')
+
+    def __init__(self, id, username, avatar_digest):
+        self.id = id
+        self.username = username
+        self.avatar_digest = avatar_digest
+
+    def avatar(self, size=64):
+        return avatar_url(self.avatar_digest, size)
+
+    def __repr__(self):
+        return '<AuthorView {}>'.format(self.username)
+
+
+class PostView(object):
+    __slots__ = ('id', 'body', 'timestamp', 'author')
+
+    def __init__(self, id, body, timestamp, author):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.author = author
+
+    def __repr__(self):
+        return '<PostView {}>'.format(self.id)
+
+
+# the columns of a posts query that views need, `model` is the entity of the
+# query, Post or PostArchive, filters, ordering and pagination are kept
+def select_posts(query, model=Post):
+    return query.join(User, User.id == model.user_id).with_entities(
+        model.id, model.body, model.timestamp, User.id, User.username, User.avatar_digest)
+
+
+# run a select_posts() query (or take its rows), returns PostView objects
+# posts of the same author share one AuthorView
+def load(rows):
+    authors = {}
+    posts = []
+    for id, body, timestamp, user_id, username, avatar_digest in rows:
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = AuthorView(user_id, username, avatar_digest)
+        posts.append(PostView(id, body, timestamp, author))
+    return posts
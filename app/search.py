@@ -1,4 +1,5 @@
-# search module for generic elasticsearch index and query logic
+# search module for generic elasticsearch index logic, post search queries
+# are in `app/postsearch.py`
 # requires setup:
 # - elasticsearch is initialized in app factory function
 # - model attribute `__searchable__`
@@ -19,22 +20,29 @@ def add_to_index(index, model):
         current_app.elasticsearch.index(index=index, id=model.id, document=payload)
 
 
+# add or replace many documents in one bulk request, `documents` maps ids
+# to the searchable fields
+def add_many_to_index(index, documents):
+    if not current_app.elasticsearch or not documents:
+        return
+    from elasticsearch.helpers import bulk
+    bulk(current_app.elasticsearch,
+         ({'_index': index, '_id': id, '_source': payload}
+          for id, payload in documents.items()))
+
+
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
     current_app.elasticsearch.delete(index=index, id=model.id)
 
 
-# use 'multi-match' query mode against all fields (['*'])
-# also support pagination
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+# remove many documents in one bulk request, documents that are not in the
+# index are skipped
+def remove_ids_from_index(index, ids):
+    if not current_app.elasticsearch or not ids:
         return
-    search = current_app.elasticsearch.search(
-        index=index,
-        query={'multi_match': {'query': query, 'fields': ['*']}},
-        from_=(page - 1) * per_page,
-        size=per_page
-    )
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+    from elasticsearch.helpers import bulk
+    bulk(current_app.elasticsearch,
+         ({'_op_type': 'delete', '_index': index, '_id': id} for id in ids),
+         raise_on_error=False)
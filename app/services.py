@@ -0,0 +1,95 @@
+# lazily initialized backend service clients
+#
+# create_app() used to build the elasticsearch client (and call its blocking
+# `info()` api), connect redis and setup the rq task queue eagerly, so every
+# process paid for these imports and network calls at boot, and the boot
+# failed when elasticsearch was unreachable.
+# Instead, each client is wrapped in a LazyService proxy that is attached to
+# the app as before (`app.elasticsearch`, `app.redis`, `app.task_queue`),
+# and the real client is only imported and created on first attribute access.
+
+import threading
+
+
+class LazyService(object):
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    # the wrapped client, created by the factory on first use
+    # double-checked locking makes sure threaded workers only create one
+    @property
+    def instance(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    @property
+    def initialized(self):
+        return self._instance is not None
+
+    # delegate everything else to the wrapped client
+    def __getattr__(self, item):
+        return getattr(self.instance, item)
+
+    def __repr__(self):
+        state = 'initialized' if self.initialized else 'not initialized'
+        return f'<LazyService {self._name} ({state})>'
+
+
+def create_elasticsearch(app):
+    from elasticsearch import Elasticsearch
+    client = Elasticsearch(
+        [app.config['ELASTICSEARCH_URL']],
+        basic_auth=(app.config['ELASTICSEARCH_USER'], app.config['ELASTICSEARCH_PASSWORD']),
+        verify_certs=None,
+        connections_per_node=app.config['ELASTICSEARCH_CONNECTIONS_PER_NODE']
+    )
+    # disable unverified https warning (due to verify_cert=None option):
+    import urllib3
+    urllib3.disable_warnings()
+    app.logger.info('Elasticsearch initialized')
+    return client
+
+
+def create_redis(app):
+    from redis import Redis
+    from app.pools import redis_connection_pool
+    return Redis(connection_pool=redis_connection_pool(app.config))
+
+
+def create_task_queue(app, name='microblog-tasks'):
+    import rq
+    # hand the real redis client (not the proxy) over to rq, app.redis may
+    # also have been replaced by a plain client, e.g. in tests
+    connection = getattr(app.redis, 'instance', app.redis)
+    return rq.Queue(name, connection=connection)
+
+
+# attach lazy service proxies to the app
+def init_app(app):
+    # the database engine itself is created lazily by flask-sqlalchemy, only
+    # its pool options are set here
+    if not app.config.get('SQLALCHEMY_ENGINE_OPTIONS'):
+        from app.pools import engine_options
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
+    if app.config['ENABLE_ELASTICSEARCH']:
+        # add elasticsearch as app attribute
+        app.elasticsearch = LazyService('elasticsearch',
+                                        lambda: create_elasticsearch(app))
+    else:
+        app.elasticsearch = None
+
+    # setup redis task queue
+    # this task queue can be access from anywhere via 'current_app'
+    app.redis = LazyService('redis', lambda: create_redis(app))
+    app.task_queue = LazyService('task_queue', lambda: create_task_queue(app))
+    # outgoing mail has its own queue, so that it is not held up by long
+    # running tasks, see `app/email.py`
+    app.mail_queue = LazyService(
+        'mail_queue', lambda: create_task_queue(app, app.config['MAIL_QUEUE']))
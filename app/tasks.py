@@ -2,27 +2,40 @@ import sys
 import time
 from rq import get_current_job
 from app import create_app, db
+from app.email import deliver, send_email
 from app.models import Task, User
 
-# create application instance for this rq worker python process
-app = create_app()
-# pushing application context makes this newly created app instance the
-# 'current_app' to be referred in this python process, therefore making
-# extensions also available, such as current_app.config
-app.app_context().push()
+# application instance for this rq worker python process
+# it is created on the first job instead of at import time, so importing this
+# module (e.g. by the web stack or tests) does not build a second app
+app = None
+
+
+def _get_app():
+    global app
+    if app is None:
+        app = create_app()
+        # pushing application context makes this newly created app instance
+        # the 'current_app' to be referred in this python process, therefore
+        # making extensions also available, such as current_app.config
+        app.app_context().push()
+    return app
 
 
 def export_posts(user_id):
+    app = _get_app()
     try:
         app.logger.info(f'export_posts job started for user: {user_id}')
         user = User.query.get(user_id)
         _set_task_progress(0)
         # todo: read user posts from db
-        # todo: send email to user when export is done
         for i in range(10):
             app.logger.info(f'... {i}/10')
             time.sleep(1)  # mimic a long-running task
         app.logger.info(f'export_posts job complete for user: {user_id}')
+        # queued for the mail worker, the export job does not wait for smtp
+        send_email('[Microblog] Your posts export', [user.email],
+                   text_body=f'Dear {user.username},\n\nyour posts export is complete.\n')
     except:  # catch all possible exceptions
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
     finally:
@@ -30,6 +43,13 @@ def export_posts(user_id):
         _set_task_progress(100)
 
 
+# send queued emails, enqueued by send_email(), see `app/email.py`
+def deliver_mail(retry=False):
+    app = _get_app()
+    sent = deliver(retry)
+    app.logger.info(f'deliver_mail job sent {sent} email(s)')
+
+
 # track job status in redis queue and save to database Task row
 def _set_task_progress(progress):
     job = get_current_job()  # get job bound to current task
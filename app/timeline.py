@@ -0,0 +1,205 @@
+# materialized home feed timeline in redis
+#
+# requires setup:
+# - ENABLE_TIMELINE_CACHE config, and redis at current_app.redis
+# - post and user changes published on session commit, see `app/models.py`
+#
+# implementation design:
+# - the ids of the newest TIMELINE_SIZE posts are kept in a sorted set
+#   scored by post timestamp, new posts are appended on commit and the set is
+#   trimmed to the window
+# - post and author cards (json) are kept in separate keys so that a page is
+#   hydrated with two MGET calls, an author card is dropped when the username
+#   or email changes
+# - a marker key tells that the sorted set holds the newest posts, it is set
+#   by rebuild() and dropped on post deletes, which leave a hole in the window
+# - rebuild() merges the database rows into the sorted set rather than
+#   replacing it, so that posts appended by other processes meanwhile are
+#   kept
+# - pages beyond the window, or any redis error, fall back to the database
+
+import json
+from datetime import datetime
+from flask import current_app
+from redis.exceptions import RedisError
+from app import locks
+from app.readmodels import AuthorView, PostView
+
+TIMELINE_KEY = 'timeline:posts'
+PRIMED_KEY = 'timeline:posts:primed'
+REBUILD_LOCK_KEY = 'timeline:posts:rebuilding'
+POST_KEY = 'timeline:post:{}'
+AUTHOR_KEY = 'timeline:author:{}'
+
+
+def _enabled():
+    return current_app.config['ENABLE_TIMELINE_CACHE']
+
+
+def _score(timestamp):
+    return (timestamp - datetime(1970, 1, 1)).total_seconds()
+
+
+# a page of the timeline, with the attributes the views read from a
+# flask-sqlalchemy Pagination
+class TimelinePage(object):
+    def __init__(self, items, page, has_next):
+        self.items = items
+        self.page = page
+        self.has_prev = page > 1
+        self.prev_num = page - 1 if self.has_prev else None
+        self.has_next = has_next
+        self.next_num = page + 1 if has_next else None
+
+
+def _post_card(post):
+    return json.dumps({'id': post['id'], 'body': post['body'],
+                       'timestamp': post['timestamp'].isoformat(),
+                       'user_id': post['user_id']})
+
+
+def _author_card(user):
+    return json.dumps({'id': user.id, 'username': user.username,
+                       'avatar_digest': user.avatar_digest})
+
+
+# append committed posts to the timeline
+# posts are dicts with id, body, timestamp and user_id, snapshot at flush
+def add_posts(posts):
+    if not _enabled() or not posts:
+        return
+    size = current_app.config['TIMELINE_SIZE']
+    ttl = current_app.config['TIMELINE_CACHE_TTL']
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.zadd(TIMELINE_KEY, {post['id']: _score(post['timestamp']) for post in posts})
+        # keep the newest `size` posts only
+        pipe.zremrangebyrank(TIMELINE_KEY, 0, -(size + 1))
+        for post in posts:
+            pipe.set(POST_KEY.format(post['id']), _post_card(post), ex=ttl)
+        pipe.execute()
+    except RedisError as e:
+        current_app.logger.warning(f'Timeline cache update failed: {e}')
+
+
+def remove_posts(post_ids):
+    if not _enabled() or not post_ids:
+        return
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.zrem(TIMELINE_KEY, *post_ids)
+        pipe.delete(*[POST_KEY.format(post_id) for post_id in post_ids])
+        # a removed post leaves a hole at the end of a full window
+        pipe.delete(PRIMED_KEY)
+        pipe.execute()
+    except RedisError as e:
+        current_app.logger.warning(f'Timeline cache update failed: {e}')
+
+
+def invalidate_authors(user_ids):
+    if not _enabled() or not user_ids:
+        return
+    try:
+        current_app.redis.delete(*[AUTHOR_KEY.format(user_id) for user_id in user_ids])
+    except RedisError as e:
+        current_app.logger.warning(f'Timeline cache update failed: {e}')
+
+
+# reload the timeline window from the database
+def rebuild():
+    from app.models import Post
+    size = current_app.config['TIMELINE_SIZE']
+    rows = Post.query.with_entities(Post.id, Post.timestamp).order_by(
+        Post.timestamp.desc()).limit(size).all()
+    pipe = current_app.redis.pipeline()
+    # posts committed since the rows were read are already in the set, the
+    # set is never deleted so that they are not lost
+    if rows:
+        pipe.zadd(TIMELINE_KEY, {id: _score(timestamp) for id, timestamp in rows})
+    pipe.zremrangebyrank(TIMELINE_KEY, 0, -(size + 1))
+    pipe.set(PRIMED_KEY, 1)
+    pipe.execute()
+    return len(rows)
+
+
+# load post cards for a list of post ids, in the given order
+# cache misses are loaded from the database with one query per key type
+def hydrate(post_ids):
+    from app.models import Post, User
+    if not post_ids:
+        return []
+    redis, ttl = current_app.redis, current_app.config['TIMELINE_CACHE_TTL']
+    cards = {}
+    for post_id, card in zip(post_ids, redis.mget([POST_KEY.format(i) for i in post_ids])):
+        if card is not None:
+            cards[post_id] = json.loads(card)
+    missing = [post_id for post_id in post_ids if post_id not in cards]
+    if missing:
+        pipe = redis.pipeline()
+        rows = Post.query.filter(Post.id.in_(missing)).with_entities(
+            Post.id, Post.body, Post.timestamp, Post.user_id)
+        for id, body, timestamp, user_id in rows:
+            card = _post_card({'id': id, 'body': body,
+                               'timestamp': timestamp, 'user_id': user_id})
+            pipe.set(POST_KEY.format(id), card, ex=ttl)
+            cards[id] = json.loads(card)
+        pipe.execute()
+
+    user_ids = list({card['user_id'] for card in cards.values()})
+    authors = {}
+    if not user_ids:
+        return []
+    for user_id, card in zip(user_ids, redis.mget([AUTHOR_KEY.format(i) for i in user_ids])):
+        if card is not None:
+            authors[user_id] = json.loads(card)
+    missing = [user_id for user_id in user_ids if user_id not in authors]
+    if missing:
+        pipe = redis.pipeline()
+        rows = User.query.filter(User.id.in_(missing)).with_entities(
+            User.id, User.username, User.avatar_digest)
+        for user in rows:
+            card = _author_card(user)
+            pipe.set(AUTHOR_KEY.format(user.id), card, ex=ttl)
+            authors[user.id] = json.loads(card)
+        pipe.execute()
+
+    posts, views = [], {}
+    for post_id in post_ids:
+        card = cards.get(post_id)
+        # skip posts deleted since their id was read
+        if card is None or card['user_id'] not in authors:
+            continue
+        author = authors[card['user_id']]
+        if author['id'] not in views:
+            views[author['id']] = AuthorView(author['id'], author['username'],
+                                             author['avatar_digest'])
+        posts.append(PostView(card['id'], card['body'],
+                              datetime.fromisoformat(card['timestamp']),
+                              views[author['id']]))
+    return posts
+
+
+# get a home feed page from the cache
+# returns None when the page has to be read from the database, i.e. the
+# cache is disabled or unavailable, or the page is beyond the cached window
+def page(page, per_page):
+    if not _enabled():
+        return None
+    page = max(page, 1)
+    start = (page - 1) * per_page
+    # read one extra id to know if there is a next page
+    stop = start + per_page
+    if stop >= current_app.config['TIMELINE_SIZE']:
+        return None
+    redis = current_app.redis
+    try:
+        if not redis.exists(PRIMED_KEY):
+            # only one process reloads the window, the others use the
+            # database meanwhile
+            if not locks.rebuild_once(REBUILD_LOCK_KEY, rebuild, 30):
+                return None
+        ids = [int(post_id) for post_id in redis.zrevrange(TIMELINE_KEY, start, stop)]
+        return TimelinePage(hydrate(ids[:per_page]), page, len(ids) > per_page)
+    except RedisError as e:
+        current_app.logger.warning(f'Timeline cache read failed: {e}')
+        return None
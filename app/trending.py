@@ -0,0 +1,232 @@
+# streaming trending terms tracker
+#
+# counting terms over all post bodies with sql grows with the post table,
+# instead committed posts are fed to approximate counters of fixed size:
+# - time is cut into TRENDING_WINDOW second windows, each window has a
+#   count-min sketch of term counts and a top-k set of its heaviest terms
+# - only the newest TRENDING_WINDOWS windows are kept, and a window weighs
+#   TRENDING_DECAY times less than the next newer one
+# - trending() merges the top-k sets of the kept windows by decayed weight,
+#   so memory and query time do not depend on the number of posts
+#
+# TRENDING_STORAGE config selects the storage, 'memory' keeps the counters
+# per process (each worker sees the posts it committed), 'redis' keeps them
+# in hashes and sorted sets shared by all processes, updated by a lua script
+# posts are fed by the session after_commit hook, see `app/models.py`
+
+import heapq
+import re
+import threading
+from array import array
+from datetime import datetime
+from flask import current_app
+from redis.exceptions import RedisError
+from app import hashing
+
+_WORD = re.compile(r"[\w#@']+")
+_STOP_WORDS = frozenset('''
+    about after again all also and any are because been before but can could
+    did does doing for from had has have having her here hers him his how into
+    its just like more most not now off once only other our out over own same
+    she should some such than that the their them then there these they this
+    those through too under until very was were what when where which while
+    who whom why will with would you your yours
+'''.split())
+
+_CMS_KEY = 'trending:cms:{}'
+_TOP_KEY = 'trending:top:{}'
+_MERGE_KEY = 'trending:merged'
+
+# add terms of one post to a window: increment the sketch cells of each
+# term, then put the term into the window top-k with its new estimate
+# KEYS: sketch hash, top-k sorted set
+# ARGV: top-k size, ttl, depth, then per term the term and its depth cells
+_ADD_SCRIPT = '''
+local k, ttl, depth = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local i = 4
+while i <= #ARGV do
+    local term = ARGV[i]
+    local estimate = nil
+    for d = 1, depth do
+        local count = redis.call('HINCRBY', KEYS[1], ARGV[i + d], 1)
+        if estimate == nil or count < estimate then
+            estimate = count
+        end
+    end
+    redis.call('ZADD', KEYS[2], estimate, term)
+    i = i + depth + 1
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -(k + 1))
+redis.call('EXPIRE', KEYS[1], ttl)
+redis.call('EXPIRE', KEYS[2], ttl)
+return 0
+'''
+
+
+# distinct terms of a post body
+def terms(body):
+    return {word.strip("'") for word in _WORD.findall((body or '').lower())
+            if len(word) >= 3 and word not in _STOP_WORDS and not word.isdigit()}
+
+
+def _window(timestamp, window_seconds):
+    return int((timestamp - datetime(1970, 1, 1)).total_seconds() // window_seconds)
+
+
+# sketch cell of a term in each row
+def _cells(term, width, depth):
+    return hashing.positions(term, depth, width)
+
+
+class CountMinSketch(object):
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('L', [0]) * width for _ in range(depth)]
+
+    def cells(self, term):
+        return _cells(term, self.width, self.depth)
+
+    # count a term, returns its new estimate
+    def add(self, term):
+        estimate = None
+        for row, cell in zip(self.rows, self.cells(term)):
+            row[cell] += 1
+            if estimate is None or row[cell] < estimate:
+                estimate = row[cell]
+        return estimate
+
+    def estimate(self, term):
+        return min(row[cell] for row, cell in zip(self.rows, self.cells(term)))
+
+
+# heaviest k terms, a dict of term estimates with a min-heap to find the
+# lightest term to evict, heap entries of updated terms are left behind and
+# skipped when popped
+class TopK(object):
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.heap = []
+
+    def update(self, term, estimate):
+        if term not in self.counts and len(self.counts) >= self.k:
+            if estimate <= self._min():
+                return
+            _, evicted = heapq.heappop(self.heap)
+            del self.counts[evicted]
+        self.counts[term] = estimate
+        heapq.heappush(self.heap, (estimate, term))
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(count, term) for term, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    # drop stale heap entries, returns the smallest current estimate
+    def _min(self):
+        while self.heap[0][0] != self.counts.get(self.heap[0][1]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0]
+
+
+class MemoryTracker(object):
+    def __init__(self, config):
+        self.config = config
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def add(self, window, post_terms):
+        with self.lock:
+            if window not in self.windows:
+                self.windows[window] = (
+                    CountMinSketch(self.config['TRENDING_SKETCH_WIDTH'],
+                                   self.config['TRENDING_SKETCH_DEPTH']),
+                    TopK(self.config['TRENDING_TOP_K']))
+                # forget windows that fell out of the kept range
+                oldest = max(self.windows) - self.config['TRENDING_WINDOWS'] + 1
+                for expired in [w for w in self.windows if w < oldest]:
+                    del self.windows[expired]
+            if window not in self.windows:
+                return
+            sketch, top = self.windows[window]
+            for term in post_terms:
+                top.update(term, sketch.add(term))
+
+    def merged(self, weights):
+        scores = {}
+        with self.lock:
+            for window, weight in weights.items():
+                if window in self.windows:
+                    for term, count in self.windows[window][1].counts.items():
+                        scores[term] = scores.get(term, 0.0) + weight * count
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class RedisTracker(object):
+    def __init__(self, config):
+        self.config = config
+        self.script = None
+
+    def add(self, window, post_terms):
+        redis = current_app.redis
+        if self.script is None:
+            self.script = redis.register_script(_ADD_SCRIPT)
+        config = self.config
+        width, depth = config['TRENDING_SKETCH_WIDTH'], config['TRENDING_SKETCH_DEPTH']
+        args = [config['TRENDING_TOP_K'],
+                config['TRENDING_WINDOW'] * config['TRENDING_WINDOWS'], depth]
+        for term in post_terms:
+            args.append(term)
+            args.extend(f'{d}:{cell}' for d, cell in enumerate(_cells(term, width, depth)))
+        self.script(keys=[_CMS_KEY.format(window), _TOP_KEY.format(window)],
+                    args=args, client=redis)
+
+    def merged(self, weights):
+        redis = current_app.redis
+        pipe = redis.pipeline()
+        pipe.zunionstore(_MERGE_KEY, {_TOP_KEY.format(window): weight
+                                      for window, weight in weights.items()})
+        pipe.zrevrange(_MERGE_KEY, 0, -1, withscores=True)
+        pipe.delete(_MERGE_KEY)
+        _, merged, _ = pipe.execute()
+        return [(term.decode('utf-8'), score) for term, score in merged]
+
+
+def _tracker():
+    storage = current_app.config['TRENDING_STORAGE']
+    if not storage:
+        return None
+    if 'trending' not in current_app.extensions:
+        cls = RedisTracker if storage == 'redis' else MemoryTracker
+        current_app.extensions['trending'] = cls(current_app.config)
+    return current_app.extensions['trending']
+
+
+# feed committed posts, dicts with body and timestamp
+def add_posts(posts):
+    tracker = _tracker()
+    if tracker is None or not posts:
+        return
+    window_seconds = current_app.config['TRENDING_WINDOW']
+    try:
+        for post in posts:
+            post_terms = terms(post['body'])
+            if post_terms:
+                tracker.add(_window(post['timestamp'], window_seconds), post_terms)
+    except RedisError as e:
+        current_app.logger.warning(f'Trending terms update failed: {e}')
+
+
+# top n terms with their decayed scores, newest window first
+def trending(n=10, now=None):
+    tracker = _tracker()
+    if tracker is None:
+        return []
+    config = current_app.config
+    current = _window(now or datetime.utcnow(), config['TRENDING_WINDOW'])
+    weights = {current - age: config['TRENDING_DECAY'] ** age
+               for age in range(config['TRENDING_WINDOWS'])}
+    try:
+        return tracker.merged(weights)[:n]
+    except RedisError as e:
+        current_app.logger.warning(f'Trending terms read failed: {e}')
+        return []
@@ -21,18 +21,123 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
                               'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # database connection pool, sized per python process (gunicorn worker),
+    # so the total connection count is `workers * (size + overflow)`
+    # see `app/pools.py`, ignored for sqlite
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 5)
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 5)
+    # seconds to wait for a free connection before giving up
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT') or 10)
+    # recycle connections before the server side (e.g. mysql wait_timeout)
+    # drops them
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 1800)
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'True') == 'True'
     # print sql in debug mode
     SQLALCHEMY_ECHO = True if os.environ.get('FLASK_ENV') == 'development' else False
     # pagination
     POSTS_PER_PAGE = 3
 
+    # password hashing, see `app/passwords.py`
+    # stored hashes with other parameters are upgraded on the next login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256'
+    PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS') or 260000)
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 16)
+    # concurrent hash computations per process, and seconds to wait for a
+    # free slot before a login is turned away
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 5)
+
     ENABLE_ELASTICSEARCH = os.environ.get('ENABLE_ELASTICSEARCH') == 'True' or False
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL') or 'https://localhost:9200'
     ELASTICSEARCH_USER = os.environ.get('ELASTICSEARCH_USER')
     ELASTICSEARCH_PASSWORD = os.environ.get('ELASTICSEARCH_PASSWORD')
+    ELASTICSEARCH_CONNECTIONS_PER_NODE = int(os.environ.get('ELASTICSEARCH_CONNECTIONS_PER_NODE') or 5)
 
     # Redis task queue
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # redis connection pool, callers wait up to REDIS_POOL_TIMEOUT seconds
+    # for a free connection when all REDIS_MAX_CONNECTIONS are in use
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS') or 10)
+    REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT') or 5)
+
+    # cache the home feed timeline in redis, see `app/timeline.py`
+    ENABLE_TIMELINE_CACHE = os.environ.get('ENABLE_TIMELINE_CACHE') == 'True' or False
+    # number of newest posts kept in the cached timeline window
+    TIMELINE_SIZE = int(os.environ.get('TIMELINE_SIZE') or 1000)
+    # seconds to keep cached post and author cards
+    TIMELINE_CACHE_TTL = int(os.environ.get('TIMELINE_CACHE_TTL') or 3600)
+
+    # rate limits of expensive routes, token buckets of (capacity, refill
+    # tokens per second) by limit name, see `app/ratelimit.py`
+    ENABLE_RATELIMIT = os.environ.get('ENABLE_RATELIMIT', 'True') == 'True'
+    # 'redis' shares the buckets between processes, 'memory' keeps them per
+    # process, redis errors fall back to memory
+    RATELIMIT_STORAGE = os.environ.get('RATELIMIT_STORAGE') or 'redis'
+    RATELIMITS = {
+        # bursts of 5 sign in attempts, then one every 12 seconds
+        'login': (5, 1 / 12),
+        'search': (10, 1),
+        'post': (5, 1 / 6),
+        # posts created through the api, charged per post: a full batch of
+        # API_MAX_BATCH, then one post every 6 seconds as on the web form,
+        # the capacity must not be below API_MAX_BATCH
+        'api_posts': (100, 1 / 6),
+    }
+
+    # bloom filter of taken usernames and emails, lets registration skip
+    # the database lookup for new names, see `app/bloom.py`
+    # 'redis' (shared by all processes), 'memory' (per process) or empty to
+    # disable
+    UNIQUENESS_BLOOM = os.environ.get('UNIQUENESS_BLOOM') or None
+    # expected number of users, and false positive rate at that size
+    BLOOM_CAPACITY = int(os.environ.get('BLOOM_CAPACITY') or 1000000)
+    BLOOM_ERROR_RATE = float(os.environ.get('BLOOM_ERROR_RATE') or 0.01)
+
+    # trending terms of recent posts, see `app/trending.py`
+    # 'memory' (per process), 'redis' (shared by all processes) or empty to
+    # disable
+    TRENDING_STORAGE = os.environ.get('TRENDING_STORAGE') or 'memory'
+    # seconds per counting window, number of windows kept, and the weight of
+    # a window relative to the next newer one
+    TRENDING_WINDOW = int(os.environ.get('TRENDING_WINDOW') or 3600)
+    TRENDING_WINDOWS = int(os.environ.get('TRENDING_WINDOWS') or 24)
+    TRENDING_DECAY = float(os.environ.get('TRENDING_DECAY') or 0.7)
+    # terms kept per window, and count-min sketch size
+    TRENDING_TOP_K = 50
+    TRENDING_SKETCH_WIDTH = 2048
+    TRENDING_SKETCH_DEPTH = 4
+
+    # serve identicon avatars rendered by the app instead of linking to
+    # gravatar, see `app/avatars/`
+    LOCAL_AVATARS = os.environ.get('LOCAL_AVATARS') == 'True' or False
+    # browser cache lifetime (seconds) of avatar images
+    AVATAR_CACHE_MAX_AGE = int(os.environ.get('AVATAR_CACHE_MAX_AGE') or 365 * 24 * 3600)
+
+    # post search, see `app/postsearch.py`
+    # seconds the elasticsearch calls of a search may take, failures in a row
+    # that open the circuit breaker, and seconds until it tries again
+    SEARCH_TIMEOUT = float(os.environ.get('SEARCH_TIMEOUT') or 0.5)
+    SEARCH_BREAKER_FAILURES = int(os.environ.get('SEARCH_BREAKER_FAILURES') or 5)
+    SEARCH_BREAKER_RESET = int(os.environ.get('SEARCH_BREAKER_RESET') or 30)
+    # threads per process running elasticsearch calls, two per search, more
+    # than ELASTICSEARCH_CONNECTIONS_PER_NODE only wait for a connection
+    SEARCH_WORKERS = int(os.environ.get('SEARCH_WORKERS') or 4)
+    # max matches counted by the database fallback
+    SEARCH_FALLBACK_MAX_RESULTS = 1000
+
+    # json api, see `app/api/`
+    # bearer token lifetime (seconds), default and max posts per page, and
+    # max posts created per batch request
+    API_TOKEN_EXPIRATION = int(os.environ.get('API_TOKEN_EXPIRATION') or 3600)
+    API_PAGE_SIZE = 20
+    API_MAX_PAGE_SIZE = 100
+    API_MAX_BATCH = 100
+
+    # log a pool exhaustion warning when a connection checkout waits longer
+    # than this many seconds
+    POOL_WAIT_WARNING = float(os.environ.get('POOL_WAIT_WARNING') or 0.5)
+    # expose in-process runtime metrics as json at `/metrics`
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED') == 'True' or False
 
     # Email server setup
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
@@ -40,3 +145,17 @@ class Config(object):
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') or 1
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER') or 'no-reply@microblog.com'
+    # recipients of error logs
+    ADMINS = [os.environ.get('ADMIN_EMAIL') or 'admin@microblog.com']
+
+    # asynchronous mail delivery, see `app/email.py`
+    # rq queue of delivery jobs, and emails sent per outbox read
+    MAIL_QUEUE = os.environ.get('MAIL_QUEUE') or 'microblog-mail'
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 100)
+    # attempts per email, and the first retry delay (seconds), doubled on
+    # each further attempt
+    MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS') or 5)
+    MAIL_RETRY_BACKOFF = int(os.environ.get('MAIL_RETRY_BACKOFF') or 30)
+    # seconds during which the same email is not sent to a recipient again
+    MAIL_DEDUP_TTL = int(os.environ.get('MAIL_DEDUP_TTL') or 24 * 3600)
@@ -1,8 +1,10 @@
-from app import create_app, db
+from app import create_app, db, cli
 from app.models import User, Post, Task
 
 
 app = create_app()
+# register custom flask cli commands, see `app/cli.py`
+cli.register(app)
 
 
 # shell_context_processor decorator registers the target function as a
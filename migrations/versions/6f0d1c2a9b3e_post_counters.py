@@ -0,0 +1,40 @@
+"""post counters
+
+Revision ID: 6f0d1c2a9b3e
+Revises: 280abf422220
+Create Date: 2026-10-19 09:12:41.208311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f0d1c2a9b3e'
+down_revision = '280abf422220'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('counter',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.add_column('user', sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill counters from existing posts
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('post_count', sa.Integer))
+    post = sa.table('post', sa.column('id', sa.Integer), sa.column('user_id', sa.Integer))
+    counter = sa.table('counter', sa.column('name', sa.String), sa.column('value', sa.Integer))
+    op.execute(user.update().values(post_count=sa.select([sa.func.count(post.c.id)]).where(
+        post.c.user_id == user.c.id).scalar_subquery()))
+    op.execute(counter.insert().from_select(['name', 'value'], sa.select([
+        sa.literal('posts'), sa.func.count(post.c.id)])))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('post_count')
+    op.drop_table('counter')
@@ -0,0 +1,26 @@
+"""composite indexes
+
+Revision ID: b41e7d5a3c08
+Revises: 6f0d1c2a9b3e
+Create Date: 2026-10-19 10:03:27.519842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b41e7d5a3c08'
+down_revision = '6f0d1c2a9b3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp', 'id'], unique=False)
+    op.create_index('ix_task_user_id_name_complete', 'task', ['user_id', 'name', 'complete'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_task_user_id_name_complete', table_name='task')
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
@@ -0,0 +1,34 @@
+"""post archive
+
+Revision ID: c93a0e7f51d2
+Revises: b41e7d5a3c08
+Create Date: 2026-10-19 11:42:08.317205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c93a0e7f51d2'
+down_revision = 'b41e7d5a3c08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('post_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('body', sa.String(length=140), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('archived_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_post_archive_user_id_timestamp', 'post_archive', ['user_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_archive_user_id_timestamp', table_name='post_archive')
+    op.drop_table('post_archive')
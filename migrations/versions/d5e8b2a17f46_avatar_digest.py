@@ -0,0 +1,40 @@
+"""avatar digest
+
+Revision ID: d5e8b2a17f46
+Revises: c93a0e7f51d2
+Create Date: 2026-10-19 13:15:52.904177
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e8b2a17f46'
+down_revision = 'c93a0e7f51d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('avatar_digest', sa.String(length=32), nullable=True))
+
+    # backfill digests of existing users, md5 is computed in python as not
+    # every database has it
+    connection = op.get_bind()
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                    sa.column('avatar_digest', sa.String))
+    rows = connection.execute(sa.select([user.c.id, user.c.email]).where(
+        user.c.email.isnot(None))).fetchall()
+    update = user.update().where(user.c.id == sa.bindparam('user_id')).values(
+        avatar_digest=sa.bindparam('digest'))
+    for start in range(0, len(rows), 1000):
+        connection.execute(update, [
+            {'user_id': id, 'digest': md5(email.lower().encode('utf-8')).hexdigest()}
+            for id, email in rows[start:start + 1000]])
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('avatar_digest')
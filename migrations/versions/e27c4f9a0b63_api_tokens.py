@@ -0,0 +1,29 @@
+"""api tokens
+
+Revision ID: e27c4f9a0b63
+Revises: d5e8b2a17f46
+Create Date: 2026-10-19 15:02:41.660318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e27c4f9a0b63'
+down_revision = 'd5e8b2a17f46'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('token', sa.String(length=32), nullable=True))
+    op.add_column('user', sa.Column('token_expiration', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_user_token'), 'user', ['token'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_token'), table_name='user')
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('token_expiration')
+        batch_op.drop_column('token')
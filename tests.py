@@ -1,7 +1,37 @@
+import inspect
+import json
+import os
+import smtplib
+import socket
+import time
 import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+import fakeredis
+import flask_mail
+import rq
+from aiosmtpd.controller import Controller
+from elastic_transport import ConnectionError as TransportConnectionError
+from elasticsearch import Elasticsearch
+from redis import Redis
+from werkzeug.security import generate_password_hash
 from config import Config
-from app import create_app, db
-from app.models import User
+import sqlite3
+from sqlalchemy import exc
+from app import create_app, db, timeline
+from app.cli import profile_startup
+from app.models import User, Post, PostArchive, Task, Counter, rebuild_post_counters
+from app.models import email_digest
+from app.pools import InstrumentedQueuePool, engine_options
+from app import passwords
+from app import metrics, ratelimit
+from app import bloom
+from app import trending
+from app import email
+from app import postsearch
+from app import archive
+from app import readmodels
+from app.cli import parse_age
 
 
 # overriding Config class with testing need
@@ -11,9 +41,14 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
 
-class UserModelCase(unittest.TestCase):
+# an app of `config_class` with a fresh testing db, redis is replaced by
+# fakeredis
+class AppTestCase(unittest.TestCase):
+    config_class = TestConfig
+
     def setUp(self) -> None:
-        self.app = create_app(TestConfig)
+        self.app = create_app(self.config_class)
+        self.app.redis = fakeredis.FakeStrictRedis()
         self.app_context = self.app.app_context()
         # app_context.push() injects context to the current active app
         # so that `current_app` is attached to this active app
@@ -29,12 +64,1058 @@ class UserModelCase(unittest.TestCase):
         # remove the injected testing application context
         self.app_context.pop()
 
+
+class UserModelCase(AppTestCase):
     def test_password_hashing(self):
         u = User(username='susan')
         u.set_password('cat')
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash_on_login(self):
+        u = User(username='susan')
+        u.password_hash = generate_password_hash('cat', method='pbkdf2:sha256:1000')
+        self.assertTrue(passwords.needs_rehash(u.password_hash))
+        self.assertFalse(u.check_password('dog'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith(passwords.hash_method() + '$'))
+        self.assertFalse(passwords.needs_rehash(u.password_hash))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_hashing_is_bounded(self):
+        self.app.config['PASSWORD_HASH_TIMEOUT'] = 0.01
+        _, slots = passwords._get_pool()
+        taken = 0
+        while slots.acquire(blocking=False):
+            taken += 1
+        try:
+            self.assertEqual(taken, self.app.config['PASSWORD_HASH_WORKERS'])
+            with self.assertRaises(passwords.PasswordHashBusy):
+                User(username='susan').set_password('cat')
+        finally:
+            for _ in range(taken):
+                slots.release()
+
+    def test_password_rehash_is_skipped_when_busy(self):
+        u = User(username='susan')
+        u.password_hash = generate_password_hash('cat', method='pbkdf2:sha256:1000')
+        old_hash = u.password_hash
+        with mock.patch('app.models.hash_password',
+                        side_effect=passwords.PasswordHashBusy('busy')):
+            self.assertTrue(u.check_password('cat'))
+        self.assertEqual(u.password_hash, old_hash)
+        # the next login upgrades it
+        self.assertTrue(u.check_password('cat'))
+        self.assertFalse(passwords.needs_rehash(u.password_hash))
+
+    def test_post_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual(u1.post_count, 0)
+        self.assertEqual(Counter.get('posts'), 0)
+
+        p1 = Post(body='post from john', author=u1)
+        p2 = Post(body='another post from john', author=u1)
+        p3 = Post(body='post from susan', author=u2)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        self.assertEqual(u1.post_count, 2)
+        self.assertEqual(u2.post_count, 1)
+        self.assertEqual(Counter.get('posts'), 3)
+
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(u1.post_count, 1)
+        self.assertEqual(Counter.get('posts'), 2)
+
+        # counters roll back with the transaction
+        db.session.add(Post(body='rolled back', author=u2))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(u2.post_count, 1)
+        self.assertEqual(Counter.get('posts'), 2)
+
+    def test_post_counters_are_updated_once_per_flush(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        updates = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE'):
+                updates.append(statement)
+
+        db.session.add_all([Post(body=f'post {i}', author=u1 if i % 3 else u2)
+                            for i in range(30)])
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            db.session.commit()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        # one per author and one of the 'posts' counter
+        self.assertEqual(len(updates), 3)
+        self.assertEqual((u1.post_count, u2.post_count), (20, 10))
+        self.assertEqual(Counter.get('posts'), 30)
+
+    def test_rebuild_post_counters(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Post(body='one', author=u), Post(body='two', author=u)])
+        db.session.commit()
+        # simulate drift from a bulk delete that bypasses mapper events
+        Post.query.filter_by(body='one').delete()
+        db.session.commit()
+        self.assertEqual(u.post_count, 2)
+        self.assertEqual(rebuild_post_counters(), 2)
+        self.assertEqual(u.post_count, 1)
+        self.assertEqual(Counter.get('posts'), 1)
+        self.assertEqual(rebuild_post_counters(), 0)
+
+
+class TimelineCase(AppTestCase):
+    class TimelineConfig(TestConfig):
+        ENABLE_TIMELINE_CACHE = True
+        TIMELINE_SIZE = 5
+
+    config_class = TimelineConfig
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def add_posts(self, count):
+        now = datetime.utcnow()
+        posts = [Post(body=f'post {i}', author=self.user,
+                      timestamp=now + timedelta(seconds=i)) for i in range(count)]
+        db.session.add_all(posts)
+        db.session.commit()
+        return [post.id for post in posts]
+
+    # count sql statements run by a function
+    def count_queries(self, func, *args):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = func(*args)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return result, len(statements)
+
+    def test_committed_posts_are_appended_and_trimmed(self):
+        ids = self.add_posts(7)
+        cached = [int(i) for i in self.app.redis.zrevrange(timeline.TIMELINE_KEY, 0, -1)]
+        self.assertEqual(cached, ids[::-1][:5])
+        # nothing is published for rolled back posts
+        db.session.add(Post(body='rolled back', author=self.user))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.app.redis.zcard(timeline.TIMELINE_KEY), 5)
+
+    def test_recent_pages_skip_the_database(self):
+        ids = self.add_posts(7)
+        # first read primes the window from the database
+        first = timeline.page(1, 2)
+        self.assertEqual([post.id for post in first.items], ids[::-1][:2])
+        page, queries = self.count_queries(timeline.page, 2, 2)
+        self.assertEqual(queries, 0)
+        self.assertEqual([post.id for post in page.items], ids[::-1][2:4])
+        self.assertEqual(page.items[0].author.username, 'john')
+        self.assertEqual(page.items[0].author.avatar(70), self.user.avatar(70))
+        self.assertTrue(page.has_prev and page.has_next)
+        # beyond the cached window
+        self.assertIsNone(timeline.page(3, 2))
+
+    def test_last_page_of_a_partial_window(self):
+        ids = self.add_posts(3)
+        page = timeline.page(2, 2)
+        self.assertEqual([post.id for post in page.items], ids[:1])
+        self.assertFalse(page.has_next)
+
+    def test_deletes_and_author_changes(self):
+        ids = self.add_posts(3)
+        timeline.page(1, 2)
+        db.session.delete(Post.query.get(ids[-1]))
+        db.session.commit()
+        self.assertFalse(self.app.redis.exists(timeline.PRIMED_KEY))
+        self.assertEqual([post.id for post in timeline.page(1, 2).items], ids[::-1][1:3])
+
+        self.user.username = 'johnny'
+        db.session.commit()
+        self.assertEqual(timeline.page(1, 2).items[0].author.username, 'johnny')
+        # last_seen updates keep the author card
+        self.user.last_seen = datetime.utcnow()
+        db.session.commit()
+        self.assertTrue(self.app.redis.exists(timeline.AUTHOR_KEY.format(self.user.id)))
+
+    def test_posts_committed_during_a_rebuild_are_kept(self):
+        ids = self.add_posts(3)
+        self.app.redis.delete(timeline.TIMELINE_KEY)
+        other = {'id': 999, 'body': 'from another worker', 'user_id': self.user.id,
+                 'timestamp': datetime.utcnow() + timedelta(hours=1)}
+
+        # another process commits a post after the rows were read
+        def after_cursor_execute(*args):
+            timeline.add_posts([other])
+
+        db.event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+        try:
+            self.assertEqual(timeline.rebuild(), 3)
+        finally:
+            db.event.remove(db.engine, 'after_cursor_execute', after_cursor_execute)
+        cached = [int(i) for i in self.app.redis.zrevrange(timeline.TIMELINE_KEY, 0, -1)]
+        self.assertEqual(cached, [999] + ids[::-1])
+
+    def test_redis_errors_fall_back_to_the_database(self):
+        self.app.redis = Redis(port=1)
+        with self.assertLogs(self.app.logger, level='WARNING'):
+            ids = self.add_posts(1)
+            self.assertIsNone(timeline.page(1, 2))
+        self.assertEqual(Post.query.get(ids[0]).body, 'post 0')
+
+
+class RateLimitCase(AppTestCase):
+    class RateLimitConfig(TestConfig):
+        WTF_CSRF_ENABLED = False
+        RATELIMIT_STORAGE = 'memory'
+        RATELIMITS = dict(TestConfig.RATELIMITS, login=(2, 0.5))
+
+    config_class = RateLimitConfig
+
+    def setUp(self) -> None:
+        ratelimit.memory_buckets.clear()
+        super().setUp()
+
+    def login(self, client, ip='10.0.0.1'):
+        return client.post('/auth/login', data={'username': 'john', 'password': 'cat'},
+                           environ_base={'REMOTE_ADDR': ip})
+
+    def assert_limited(self):
+        client = self.app.test_client()
+        self.assertEqual(self.login(client).status_code, 302)
+        self.assertEqual(self.login(client).status_code, 302)
+        response = self.login(client)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '2')
+        # other clients have their own bucket
+        self.assertEqual(self.login(client, ip='10.0.0.2').status_code, 302)
+        # only POST is limited
+        self.assertEqual(client.get('/auth/login').status_code, 200)
+
+    def test_memory_token_bucket(self):
+        self.assert_limited()
+        self.assertGreater(metrics.timing_stats('ratelimit').count, 0)
+
+    def test_redis_token_bucket(self):
+        self.app.config['RATELIMIT_STORAGE'] = 'redis'
+        self.assert_limited()
+        self.assertTrue(self.app.redis.exists('ratelimit:login:ip:10.0.0.1'))
+
+    def test_refill(self):
+        buckets = ratelimit.MemoryBuckets()
+        self.assertEqual(buckets.take('k', 1, 0.5, 100.0), (True, 0.0))
+        self.assertEqual(buckets.take('k', 1, 0.5, 101.0), (False, 1.0))
+        self.assertEqual(buckets.take('k', 1, 0.5, 102.0), (True, 0.0))
+        self.assertEqual(buckets.take('c', 3, 0.5, 100.0, cost=2), (True, 0.0))
+        self.assertEqual(buckets.take('c', 3, 0.5, 100.0, cost=2), (False, 2.0))
+
+
+class BloomCase(AppTestCase):
+    class BloomConfig(TestConfig):
+        WTF_CSRF_ENABLED = False
+        ENABLE_RATELIMIT = False
+        UNIQUENESS_BLOOM = 'memory'
+        BLOOM_CAPACITY = 1000
+
+    config_class = BloomConfig
+
+    def setUp(self) -> None:
+        super().setUp()
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+
+    def assert_filter(self):
+        # the filter is built from the user table on first use
+        self.assertTrue(bloom.might_exist('username', 'john'))
+        self.assertTrue(bloom.might_exist('username', 'John'))
+        self.assertTrue(bloom.might_exist('email', 'john@example.com'))
+        self.assertFalse(bloom.might_exist('username', 'susan'))
+        self.assertFalse(bloom.might_exist('email', 'john'))
+        # inserts and renames are added
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        self.assertTrue(bloom.might_exist('username', 'susan'))
+        User.query.filter_by(username='john').first().username = 'johnny'
+        db.session.commit()
+        self.assertTrue(bloom.might_exist('username', 'johnny'))
+
+    def test_memory_filter(self):
+        self.assert_filter()
+
+    def test_redis_filter(self):
+        self.app.config['UNIQUENESS_BLOOM'] = 'redis'
+        self.app.extensions.pop('bloom')
+        self.assertFalse(self.app.redis.exists(bloom.READY_KEY))
+        self.assert_filter()
+        self.assertTrue(self.app.redis.exists(bloom.READY_KEY))
+
+    def test_disabled_filter_checks_the_database(self):
+        self.app.config['UNIQUENESS_BLOOM'] = None
+        self.app.extensions.pop('bloom')
+        self.assertTrue(bloom.might_exist('username', 'susan'))
+
+    def test_unique_index_is_the_final_authority(self):
+        bloom.rebuild()
+        # a user the filter has not seen, e.g. added by another process
+        db.session.execute(User.__table__.insert().values(
+            username='susan', email='susan@example.com'))
+        db.session.commit()
+        self.assertFalse(bloom.might_exist('username', 'susan'))
+        response = self.app.test_client().post('/auth/register', data={
+            'username': 'susan', 'email': 'susan@example.com',
+            'password': 'secret', 'password2': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'already taken', response.data)
+        self.assertEqual(User.query.filter_by(username='susan').count(), 1)
+
+
+class TrendingCase(AppTestCase):
+    class TrendingConfig(TestConfig):
+        TRENDING_WINDOW = 60
+        TRENDING_WINDOWS = 3
+        TRENDING_DECAY = 0.5
+
+    config_class = TrendingConfig
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.now = datetime.utcnow()
+
+    def post(self, body, minutes_ago=0):
+        db.session.add(Post(body=body, author=self.user,
+                            timestamp=self.now - timedelta(minutes=minutes_ago)))
+        db.session.commit()
+
+    def assert_trending(self):
+        self.post('Flask is great, flask is fun')
+        self.post('Learning flask and redis')
+        self.post('flask blueprints')
+        self.post('redis streams')
+        # older windows weigh less, windows beyond the kept range are dropped
+        self.post('elasticsearch elasticsearch', minutes_ago=1)
+        self.post('mysql', minutes_ago=1)
+        self.post('mysql', minutes_ago=1)
+        self.post('mysql', minutes_ago=1)
+        self.post('ancient ancient ancient', minutes_ago=10)
+        terms = dict(trending.trending(10, now=self.now))
+        self.assertEqual([term for term, _ in trending.trending(2, now=self.now)],
+                         ['flask', 'redis'])
+        self.assertEqual(terms['flask'], 3)
+        self.assertEqual(terms['mysql'], 1.5)
+        self.assertEqual(terms['elasticsearch'], 0.5)
+        self.assertNotIn('ancient', terms)
+        self.assertNotIn('and', terms)
+
+    def test_memory_tracker(self):
+        self.assert_trending()
+
+    def test_redis_tracker(self):
+        self.app.config['TRENDING_STORAGE'] = 'redis'
+        self.app.extensions.pop('trending')
+        self.assert_trending()
+
+    def test_top_k_evicts_lightest_terms(self):
+        top = trending.TopK(2)
+        for term, estimate in [('a', 1), ('b', 2), ('a', 3), ('c', 2), ('d', 4)]:
+            top.update(term, estimate)
+        self.assertEqual(top.counts, {'a': 3, 'd': 4})
+
+    def test_trending_route(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.user.set_password('cat')
+        self.post('flask flask')
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        response = client.get('/trending')
+        self.assertEqual(response.get_json()['terms'], [{'term': 'flask', 'score': 1.0}])
+        self.post('redis')
+        for limit in (-1, 0, 1):
+            response = client.get(f'/trending?limit={limit}')
+            self.assertEqual(len(response.get_json()['terms']), 1)
+
+
+class ArchiveCase(AppTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.user = User(username='john', email='john@example.com')
+        other = User(username='susan', email='susan@example.com')
+        now = datetime.utcnow()
+        db.session.add(Post(body='old other', author=other,
+                            timestamp=now - timedelta(days=30)))
+        # post i is i days old, ids follow timestamps
+        for i in reversed(range(7)):
+            db.session.add(Post(body=f'post {i}', author=self.user,
+                                timestamp=now - timedelta(days=i)))
+            db.session.flush()
+        db.session.commit()
+        self.now = now
+
+    def test_archive_moves_old_posts_in_batches(self):
+        moved = archive.archive_posts(self.now - timedelta(days=2, hours=12), batch_size=2)
+        self.assertEqual(moved, 5)
+        self.assertEqual(sorted(p.body for p in Post.query), ['post 0', 'post 1', 'post 2'])
+        self.assertEqual(PostArchive.query.count(), 5)
+        self.assertEqual(PostArchive.query.filter_by(body='old other').one().author.username,
+                         'susan')
+        # archived posts keep counting, and the counters survive a rebuild
+        self.assertEqual(self.user.post_count, 7)
+        self.assertEqual(Counter.get('posts'), 8)
+        self.assertEqual(Counter.get('archived_posts'), 5)
+        self.assertEqual(rebuild_post_counters(), 0)
+        self.assertEqual(archive.archive_posts(self.now - timedelta(days=2, hours=12)), 0)
+
+    def test_archived_ids_are_not_reused(self):
+        # the last post is kept, so that its id is not handed out again
+        self.assertEqual(archive.archive_posts(self.now + timedelta(days=1)), 7)
+        self.assertEqual([p.body for p in Post.query], ['post 0'])
+        post = Post(body='new', author=self.user, timestamp=self.now + timedelta(hours=1))
+        db.session.add(post)
+        db.session.commit()
+        self.assertIsNone(PostArchive.query.get(post.id))
+        self.assertEqual(archive.archive_posts(self.now + timedelta(days=1)), 1)
+        self.assertEqual(PostArchive.query.count(), 8)
+        self.assertEqual([p.body for p in Post.query], ['new'])
+
+    def test_user_posts_read_through_to_archive(self):
+        archive.archive_posts(self.now - timedelta(days=2, hours=12))
+        total = self.user.post_count
+        pages = [archive.user_posts(self.user, page, 3, total) for page in (1, 2, 3)]
+        self.assertEqual([[p.body for p in pg.items] for pg in pages],
+                         [['post 0', 'post 1', 'post 2'],
+                          ['post 3', 'post 4', 'post 5'],
+                          ['post 6']])
+        self.assertTrue(pages[1].has_next)
+        self.assertFalse(pages[2].has_next)
+        # a page that straddles the hot and archived posts
+        page = archive.user_posts(self.user, 2, 2, total)
+        self.assertEqual([p.body for p in page.items], ['post 2', 'post 3'])
+        self.assertEqual(archive.user_posts(self.user, 4, 2, total).items[0].body, 'post 6')
+
+    def test_parse_age(self):
+        self.assertEqual(parse_age('90d'), timedelta(days=90))
+        self.assertEqual(parse_age('12w'), timedelta(weeks=12))
+        self.assertEqual(parse_age('36h'), timedelta(hours=36))
+        self.assertEqual(parse_age('30'), timedelta(days=30))
+
+
+class ReadModelCase(AppTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        john = User(username='john', email='John@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        now = datetime.utcnow()
+        for i, author in enumerate([john, susan, john]):
+            db.session.add(Post(body=f'post {i}', author=author,
+                                timestamp=now - timedelta(minutes=i)))
+        db.session.commit()
+
+    def test_load_views(self):
+        query = Post.query.order_by(Post.timestamp.desc())
+        posts = readmodels.load(readmodels.select_posts(query).limit(3))
+        self.assertEqual([p.body for p in posts], ['post 0', 'post 1', 'post 2'])
+        self.assertEqual([p.author.username for p in posts], ['john', 'susan', 'john'])
+        # posts of one author share the author view, no entities are loaded
+        self.assertIs(posts[0].author, posts[2].author)
+        self.assertEqual(len(db.session.identity_map), 0)
+        self.assertFalse(hasattr(posts[0], '__dict__'))
+        self.assertEqual(posts[0].author.avatar(36), User.query.first().avatar(36))
+
+
+class AvatarCase(AppTestCase):
+    def test_avatar_digest_follows_email(self):
+        u = User(username='john', email='John@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(u.avatar_digest, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        db.session.commit()
+        self.assertEqual(User.query.get(u.id).avatar_digest,
+                         email_digest('susan@example.com'))
+
+    def test_local_identicons(self):
+        self.app.config['LOCAL_AVATARS'] = True
+        u = User(username='john', email='john@example.com')
+        client = self.app.test_client()
+        with self.app.test_request_context():
+            url = u.avatar(128)
+        self.assertEqual(url, f'/avatars/{u.avatar_digest}/128')
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/svg+xml')
+        self.assertIn('width="128"', response.get_data(as_text=True))
+        self.assertTrue(response.cache_control.public)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, self.app.config['AVATAR_CACHE_MAX_AGE'])
+        # a cached image is revalidated by etag
+        again = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(client.get('/avatars/not-a-digest/128').status_code, 404)
+        self.assertEqual(client.get(f'/avatars/{u.avatar_digest}/4096').status_code, 404)
+
+    def test_gravatar_when_disabled(self):
+        u = User(username='john', email='john@example.com')
+        self.assertTrue(u.avatar(36).startswith('https://www.gravatar.com/avatar/'))
+        response = self.app.test_client().get(f'/avatars/{u.avatar_digest}/36')
+        self.assertEqual(response.status_code, 404)
+
+
+# local smtp sink, collects (connection, recipients, message) tuples and
+# replies to RCPT TO of the addresses in `refuse` with the given reply
+class SmtpSink(object):
+    def __init__(self):
+        self.messages = []
+        self.refuse = {}
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refuse:
+            return self.refuse[address]
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((session.peer, envelope.rcpt_tos, envelope.content))
+        return '250 Message accepted for delivery'
+
+
+class MailCase(AppTestCase):
+    def setUp(self) -> None:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.sink = SmtpSink()
+        self.smtp = Controller(self.sink, hostname='127.0.0.1', port=port)
+        self.smtp.start()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = port
+            MAIL_USE_TLS = False
+            MAIL_SUPPRESS_SEND = False
+            MAIL_BATCH_SIZE = 2
+
+        self.config_class = MailConfig
+        super().setUp()
+        self.app.mail_queue = rq.Queue('microblog-mail', connection=self.app.redis)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.smtp.stop()
+
+    def test_queued_mail_is_sent_over_one_connection(self):
+        recipients = ['a@example.com', 'b@example.com', 'c@example.com']
+        self.assertEqual(email.send_email('hello', recipients, 'hi'), recipients)
+        email.send_email('other', ['a@example.com'], 'hi again')
+        # nothing is sent until the job runs, and one job is waiting
+        self.assertEqual(self.sink.messages, [])
+        self.assertEqual(len(self.app.mail_queue), 1)
+        self.assertEqual(email.deliver(), 4)
+        self.assertEqual(sorted(rcpt[0] for _, rcpt, _ in self.sink.messages),
+                         ['a@example.com', 'a@example.com', 'b@example.com', 'c@example.com'])
+        self.assertEqual(len({peer for peer, _, _ in self.sink.messages}), 1)
+        self.assertEqual(self.app.redis.zcard(email.OUTBOX_KEY), 0)
+
+    def test_same_email_is_sent_once_per_recipient(self):
+        email.send_email('hello', ['a@example.com'], 'hi')
+        self.assertEqual(email.send_email('hello', ['A@example.com', 'b@example.com'], 'hi'),
+                         ['b@example.com'])
+        email.deliver()
+        self.assertEqual(len(self.sink.messages), 2)
+
+    def test_temporary_failures_are_retried_with_backoff(self):
+        self.sink.refuse['busy@example.com'] = '451 Try again later'
+        self.sink.refuse['gone@example.com'] = '550 No such user'
+        email.send_email('hello', ['busy@example.com', 'gone@example.com', 'ok@example.com'], 'hi')
+        self.assertEqual(email.deliver(), 1)
+        # the refused recipient is back in the outbox, due after the backoff
+        [(entry, due)] = self.app.redis.zrange(email.OUTBOX_KEY, 0, -1, withscores=True)
+        self.assertEqual(json.loads(entry)['recipient'], 'busy@example.com')
+        self.assertAlmostEqual(due - time.time(), self.app.config['MAIL_RETRY_BACKOFF'], delta=5)
+        self.assertEqual(len(rq.registry.ScheduledJobRegistry(queue=self.app.mail_queue)), 1)
+        # the rejected email may be sent again later
+        self.assertEqual(email.send_email('hello', ['gone@example.com'], 'hi'),
+                         ['gone@example.com'])
+
+        # the retry job sends it once the server accepts it
+        del self.sink.refuse['busy@example.com']
+        self.app.redis.zadd(email.OUTBOX_KEY, {entry: time.time()})
+        self.assertEqual(email.deliver(retry=True), 1)
+
+    def test_unreachable_server_keeps_mail_queued(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.app.extensions['mail'].port = s.getsockname()[1]
+        email.send_email('hello', ['a@example.com'], 'hi')
+        self.assertEqual(email.deliver(), 0)
+        [entry] = self.app.redis.zrange(email.OUTBOX_KEY, 0, -1)
+        self.assertEqual(json.loads(entry)['attempts'], 1)
+
+    def test_broken_email_is_dropped_alone(self):
+        email.send_email('bad\nsubject', ['a@example.com'], 'hi')
+        email.send_email('hello', ['b@example.com'], 'hi')
+        with self.assertLogs(self.app.logger, level='ERROR'):
+            self.assertEqual(email.deliver(), 1)
+        self.assertEqual([rcpt for _, rcpt, _ in self.sink.messages], [['b@example.com']])
+        self.assertEqual(self.app.redis.zcard(email.OUTBOX_KEY), 0)
+
+    def test_claimed_mail_goes_back_when_the_job_breaks(self):
+        email.send_email('hello', ['a@example.com', 'b@example.com'], 'hi')
+        with mock.patch.object(email.mail, 'connect', side_effect=RuntimeError('broken setup')):
+            with self.assertLogs(self.app.logger, level='ERROR'):
+                self.assertEqual(email.deliver(), 0)
+        entries = [json.loads(entry) for entry in self.app.redis.zrange(email.OUTBOX_KEY, 0, -1)]
+        self.assertEqual(sorted(entry['recipient'] for entry in entries),
+                         ['a@example.com', 'b@example.com'])
+        # only the first email counts the failure
+        self.assertEqual(sorted(entry['attempts'] for entry in entries), [0, 1])
+
+    def test_untried_mail_is_not_charged_when_the_connection_drops(self):
+        self.app.config['MAIL_BATCH_SIZE'] = 3
+        email.send_email('hello', ['a@example.com', 'b@example.com', 'c@example.com'], 'hi')
+        queued = dict(self.app.redis.zrange(email.OUTBOX_KEY, 0, -1, withscores=True))
+        send = flask_mail.Connection.send
+        calls = []
+
+        def drop_second(connection, message, *args):
+            calls.append(message.recipients)
+            if len(calls) == 2:
+                raise smtplib.SMTPServerDisconnected('gone')
+            return send(connection, message, *args)
+
+        with mock.patch.object(flask_mail.Connection, 'send', autospec=True,
+                               side_effect=drop_second):
+            self.assertEqual(email.deliver(), 1)
+        self.assertEqual(len(calls), 2)
+        entries = {json.loads(member)['recipient']: (json.loads(member), score) for member, score
+                   in self.app.redis.zrange(email.OUTBOX_KEY, 0, -1, withscores=True)}
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[calls[1][0]][0]['attempts'], 1)
+        # the email that was not tried is back as it was
+        (untried, score), = [entries[r] for r in entries if r != calls[1][0]]
+        self.assertEqual(untried['attempts'], 0)
+        self.assertEqual(score, queued[json.dumps(untried).encode()])
+        # and the next job waits for the backoff instead of reconnecting now
+        self.assertEqual(len(self.app.mail_queue.scheduled_job_registry), 1)
+        self.assertGreater(self.app.redis.ttl(email.RETRY_KEY), 600)
+
+
+class ApiCase(AppTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.app.config['RATELIMIT_STORAGE'] = 'memory'
+        ratelimit.memory_buckets.clear()
+        self.user = User(username='john', email='john@example.com')
+        self.user.set_password('cat')
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def token_headers(self):
+        response = self.client.post('/api/tokens', auth=('john', 'cat'))
+        self.assertEqual(response.status_code, 200)
+        return {'Authorization': f"Bearer {response.get_json()['token']}"}
+
+    def test_token_auth(self):
+        self.assertEqual(self.client.post('/api/tokens', auth=('john', 'dog')).status_code, 401)
+        self.assertEqual(self.client.get('/api/posts').status_code, 401)
+        headers = self.token_headers()
+        self.assertEqual(self.client.get('/api/posts', headers=headers).status_code, 200)
+        self.assertEqual(self.client.delete('/api/tokens', headers=headers).status_code, 204)
+        response = self.client.get('/api/posts', headers=headers)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json()['error'], 'Unauthorized')
+
+    def test_batch_create_and_cursor_paging(self):
+        headers = self.token_headers()
+        bodies = [f'post {i}' for i in range(5)]
+        response = self.client.post('/api/posts', headers=headers,
+                                    json={'posts': [{'body': body} for body in bodies]})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.get_json()['items']), 5)
+        self.assertEqual(User.query.get(self.user.id).post_count, 5)
+
+        seen, cursor = [], None
+        while True:
+            response = self.client.get('/api/posts', headers=headers,
+                                       query_string={'limit': 2, 'cursor': cursor} if cursor
+                                       else {'limit': 2})
+            page = response.get_json()
+            seen += [item['body'] for item in page['items']]
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        # same timestamp, newest id first
+        self.assertEqual(seen, bodies[::-1])
+        self.assertEqual(page['items'][0]['author']['username'], 'john')
+
+        response = self.client.get('/api/posts', headers=headers,
+                                   query_string={'cursor': 'nonsense'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_user_posts_read_through_to_archive(self):
+        headers = self.token_headers()
+        now = datetime.utcnow()
+        for i in reversed(range(4)):
+            db.session.add(Post(body=f'post {i}', author=self.user,
+                                timestamp=now - timedelta(days=i)))
+            db.session.flush()
+        db.session.commit()
+        self.assertEqual(archive.archive_posts(now - timedelta(days=1, hours=12)), 2)
+        url = f'/api/users/{self.user.id}/posts'
+        first = self.client.get(url, headers=headers, query_string={'limit': 3}).get_json()
+        second = self.client.get(url, headers=headers, query_string={
+            'limit': 3, 'cursor': first['next_cursor']}).get_json()
+        self.assertEqual([item['body'] for item in first['items'] + second['items']],
+                         ['post 0', 'post 1', 'post 2', 'post 3'])
+        self.assertIsNone(second['next_cursor'])
+        response = self.client.get('/api/users/99/posts', headers=headers)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error'], 'Not Found')
+
+    def test_invalid_batches_are_rejected(self):
+        headers = self.token_headers()
+        for payload in [{}, {'posts': []}, {'posts': [{'body': ''}]},
+                        {'posts': [{'body': 'ok'}, {'body': 'x' * 141}]},
+                        {'posts': [{'body': 'ok'}] * 101}]:
+            with self.subTest(payload=str(payload)[:40]):
+                response = self.client.post('/api/posts', headers=headers, json=payload)
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(Post.query.count(), 0)
+
+    def test_batch_create_statements(self):
+        headers = self.token_headers()
+        batch = {'posts': [{'body': f'post {i}'} for i in range(100)]}
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement.split()[0])
+
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            with mock.patch('app.models.add_many_to_index') as add_many_to_index:
+                response = self.client.post('/api/posts', headers=headers, json=batch)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(response.status_code, 201)
+        # the token user, the posts, one update of the author and one of the
+        # 'posts' counter, which is inserted as this is the first post, posts
+        # are not reloaded for the response or the search index
+        self.assertEqual(statements.count('SELECT'), 1)
+        self.assertEqual(statements.count('INSERT'), 101)
+        self.assertEqual(statements.count('UPDATE'), 2)
+        (index, documents), _ = add_many_to_index.call_args
+        self.assertEqual(index, 'post')
+        self.assertEqual(sorted(documents), [item['id'] for item in response.get_json()['items']])
+        self.assertEqual(set(d['body'] for d in documents.values()),
+                         {item['body'] for item in batch['posts']})
+
+    def test_batches_are_rate_limited_per_post(self):
+        headers = self.token_headers()
+        capacity, _ = self.app.config['RATELIMITS']['api_posts']
+        batch = {'posts': [{'body': 'hi'}] * (capacity - 1)}
+        self.assertEqual(self.client.post('/api/posts', headers=headers, json=batch).status_code, 201)
+        response = self.client.post('/api/posts', headers=headers,
+                                    json={'posts': [{'body': 'hi'}] * 2})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '6')
+        self.assertEqual(self.client.post('/api/posts', headers=headers,
+                                          json={'posts': [{'body': 'hi'}]}).status_code, 201)
+        self.assertEqual(Post.query.count(), capacity)
+
+    def test_json_serialization(self):
+        from app.api.responses import dumps, orjson
+        payload = {'timestamp': datetime(2021, 7, 1, 12, 30, 15, 250000)}
+        self.assertEqual(json.loads(dumps(payload))['timestamp'],
+                         '2021-07-01T12:30:15.250000+00:00')
+        if orjson is not None:
+            from app.api import responses
+            responses.orjson = None
+            try:
+                self.assertEqual(json.loads(dumps(payload))['timestamp'],
+                                 '2021-07-01T12:30:15.250000+00:00')
+            finally:
+                responses.orjson = orjson
+
+
+# stands in for the elasticsearch client, answers with the given post ids
+# after `delay` seconds, or raises `error`, calls are checked against the
+# signatures of the real client
+class FakeSearch(object):
+    def __init__(self, ids, delay=0.0, error=None):
+        self.ids = ids
+        self.delay = delay
+        self.error = error
+        self.calls = []
+
+    def _answer(self, method, kwargs, result):
+        inspect.signature(getattr(Elasticsearch, method)).bind(self, **kwargs)
+        self.calls.append(method)
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return result
+
+    def options(self, **kwargs):
+        inspect.signature(Elasticsearch.options).bind(self, **kwargs)
+        return self
+
+    def search(self, **kwargs):
+        start, size = kwargs['from_'], kwargs['size']
+        return self._answer('search', kwargs, {'hits': {'hits': [
+            {'_id': str(id)} for id in self.ids[start:start + size]]}})
+
+    def count(self, **kwargs):
+        return self._answer('count', kwargs, {'count': len(self.ids)})
+
+
+class SearchCase(AppTestCase):
+    class SearchConfig(TestConfig):
+        SEARCH_TIMEOUT = 0.2
+        SEARCH_BREAKER_FAILURES = 2
+        SEARCH_BREAKER_RESET = 30
+
+    config_class = SearchConfig
+
+    def setUp(self) -> None:
+        super().setUp()
+        user = User(username='john', email='john@example.com')
+        for body in ['flask tips', 'redis and flask', 'about 100% of it', 'nothing here']:
+            db.session.add(Post(body=body, author=user))
+        db.session.commit()
+
+    def use_client(self, client):
+        self.app.elasticsearch = client
+
+    def test_hits_and_count_are_fetched_concurrently(self):
+        client = FakeSearch([2, 1, 3], delay=0.1)
+        self.use_client(client)
+        start = time.perf_counter()
+        posts, total = postsearch.search_posts('flask', 1, 2)
+        # both calls take 0.1s, together well under the 0.2s timeout
+        self.assertLess(time.perf_counter() - start, 0.19)
+        self.assertEqual(sorted(client.calls), ['count', 'search'])
+        self.assertEqual(([p.body for p in posts], total),
+                         (['redis and flask', 'flask tips'], 3))
+
+    def test_slow_elasticsearch_falls_back_to_database(self):
+        self.use_client(FakeSearch([1], delay=1))
+        start = time.perf_counter()
+        posts, total = postsearch.search_posts('flask', 1, 5)
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(sorted(p.body for p in posts), ['flask tips', 'redis and flask'])
+        self.assertEqual(total, 2)
+        # like wildcards in the expression are matched literally
+        posts, total = postsearch.search_posts('100%', 1, 5)
+        self.assertEqual([p.body for p in posts], ['about 100% of it'])
+
+    def test_circuit_breaker_skips_failing_elasticsearch(self):
+        client = FakeSearch([1], error=TransportConnectionError('connection refused'))
+        self.use_client(client)
+        postsearch.search_posts('flask', 1, 5)
+        postsearch.search_posts('flask', 1, 5)
+        breaker = self.app.extensions['search_breaker']
+        self.assertTrue(breaker.open)
+        calls = len(client.calls)
+        self.assertEqual(postsearch.search_posts('flask', 1, 5)[1], 2)
+        self.assertEqual(len(client.calls), calls)
+        # a trial call after the reset period closes it again
+        breaker.opened_at -= self.SearchConfig.SEARCH_BREAKER_RESET
+        client.error = None
+        self.assertEqual(postsearch.search_posts('flask', 1, 5)[1], 1)
+        self.assertFalse(breaker.open)
+
+    def test_bugs_are_not_taken_for_outages(self):
+        self.use_client(FakeSearch([1], error=TypeError('unexpected keyword argument')))
+        with self.assertRaises(TypeError):
+            postsearch.search_posts('flask', 1, 5)
+        self.assertEqual(self.app.extensions['search_breaker'].failed, 0)
+
+    def test_database_search_without_elasticsearch(self):
+        self.app.elasticsearch = None
+        self.assertEqual(postsearch.search_posts('redis', 1, 5)[1], 1)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        User.query.first().set_password('cat')
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        response = client.get('/search', query_string={'q': 'redis'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('redis and flask', response.get_data(as_text=True))
+
+
+# run sqlite `EXPLAIN QUERY PLAN` on a query, returns the plan detail lines
+def explain_query_plan(query):
+    statement = query.statement.compile(dialect=db.engine.dialect,
+                                        compile_kwargs={'literal_binds': True})
+    rows = db.session.execute(db.text(f'EXPLAIN QUERY PLAN {statement}'))
+    return [row[-1] for row in rows]
+
+
+# plan lines that read a whole table, or sort rows after reading them
+# scan_indexes are indexes that may be scanned in order, e.g. to read the
+# newest rows of a table under a LIMIT
+def plan_regressions(plan, scan_indexes=()):
+    regressions = []
+    for detail in plan:
+        if 'TEMP B-TREE' in detail:
+            regressions.append(detail)
+        elif detail.startswith('SCAN') and not any(
+                detail.endswith(f'USING INDEX {index}') or
+                detail.endswith(f'USING COVERING INDEX {index}')
+                for index in scan_indexes):
+            regressions.append(detail)
+    return regressions
+
+
+class QueryPlanCase(AppTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def hot_queries(self):
+        user, per_page = self.user, self.app.config['POSTS_PER_PAGE']
+        return {
+            # home feed, the newest posts of everyone
+            'index': (Post.query.order_by(Post.timestamp.desc()).limit(per_page),
+                      ['ix_post_timestamp']),
+            'user_timeline': (user.posts.order_by(
+                Post.timestamp.desc(), Post.id.desc()).limit(per_page), []),
+            'user_archive': (user.archived_posts.order_by(
+                PostArchive.timestamp.desc(), PostArchive.id.desc()).limit(per_page), []),
+            # the same pages as read models, joined with the authors
+            'index_read_model': (readmodels.select_posts(
+                Post.query.order_by(Post.timestamp.desc())).limit(per_page),
+                ['ix_post_timestamp']),
+            'user_timeline_read_model': (readmodels.select_posts(user.posts.order_by(
+                Post.timestamp.desc(), Post.id.desc())).limit(per_page), []),
+            # api pages after a cursor
+            'api_posts': (Post.query.filter(db.tuple_(Post.timestamp, Post.id) < (
+                datetime.utcnow(), 1)).order_by(
+                Post.timestamp.desc(), Post.id.desc()).limit(per_page), []),
+            'api_user_posts': (user.posts.filter(db.tuple_(Post.timestamp, Post.id) < (
+                datetime.utcnow(), 1)).order_by(
+                Post.timestamp.desc(), Post.id.desc()).limit(per_page), []),
+            'user_by_token': (User.query.filter_by(token='0' * 32), []),
+            'user_by_username': (User.query.filter_by(username='john'), []),
+            'user_by_email': (User.query.filter_by(email='john@example.com'), []),
+            'load_user': (User.query.filter_by(id=user.id), []),
+            'tasks_in_progress': (Task.query.filter_by(user=user, complete=False), []),
+            'task_in_progress': (Task.query.filter_by(
+                user=user, name='export_posts', complete=False), []),
+        }
+
+    def test_hot_queries_use_indexes(self):
+        for name, (query, scan_indexes) in self.hot_queries().items():
+            with self.subTest(query=name):
+                plan = explain_query_plan(query)
+                self.assertEqual(plan_regressions(plan, scan_indexes), [], plan)
+
+    def test_full_scan_is_detected(self):
+        plan = explain_query_plan(Post.query.filter_by(body='hello'))
+        self.assertEqual(len(plan_regressions(plan)), 1)
+
+
+class StartupCase(unittest.TestCase):
+    # cold start budget in seconds for `from app import create_app` plus
+    # `create_app()` in a fresh interpreter
+    STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET') or 3.0)
+
+    def test_cold_start_budget(self):
+        # development env skips the production file logging setup
+        env = dict(os.environ, FLASK_ENV='development')
+        timings, imports = profile_startup(env)
+        self.assertLess(timings['total'], self.STARTUP_BUDGET)
+        self.assertEqual([name for name, _ in timings['spans']],
+                         ['extensions', 'blueprints', 'services'])
+        # backend clients are not imported at startup
+        modules = [module for module, _, _ in imports]
+        self.assertNotIn('elasticsearch', modules)
+        self.assertNotIn('rq', modules)
+
+    def test_services_are_lazy(self):
+        class UnreachableConfig(TestConfig):
+            ENABLE_ELASTICSEARCH = True
+            ELASTICSEARCH_URL = 'https://localhost:1'
+            REDIS_URL = 'redis://localhost:1'
+
+        start = time.perf_counter()
+        app = create_app(UnreachableConfig)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertFalse(app.elasticsearch.initialized)
+        self.assertFalse(app.redis.initialized)
+        self.assertFalse(app.task_queue.initialized)
+        # redis client is created on first use
+        self.assertEqual(app.task_queue.name, 'microblog-tasks')
+        self.assertTrue(app.redis.initialized)
+
+
+class PoolCase(unittest.TestCase):
+    def test_engine_options(self):
+        config = dict(vars(Config), SQLALCHEMY_DATABASE_URI='sqlite://')
+        self.assertEqual(engine_options(config), {'pool_pre_ping': True})
+        config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://u:p@mysql/microblog'
+        options = engine_options(config)
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], Config.DB_POOL_SIZE)
+        self.assertEqual(options['max_overflow'], Config.DB_MAX_OVERFLOW)
+
+    def test_pool_telemetry(self):
+        pool = InstrumentedQueuePool(lambda: sqlite3.connect(':memory:'),
+                                     pool_size=1, max_overflow=0, timeout=0.1)
+        checkouts, timeouts = pool.stats.checkouts, pool.stats.timeouts
+        conn = pool.connect()
+        self.assertEqual(pool.stats.checkouts, checkouts + 1)
+        self.assertEqual(pool.stats.in_use, 1)
+        with self.assertLogs('app.metrics', level='WARNING'):
+            with self.assertRaises(exc.TimeoutError):
+                pool.connect()
+        self.assertEqual(pool.stats.timeouts, timeouts + 1)
+        conn.close()
+        self.assertEqual(pool.stats.in_use, 0)
+
+    def test_metrics_route(self):
+        class MetricsConfig(TestConfig):
+            METRICS_ENABLED = True
+
+        self.assertEqual(create_app(TestConfig).test_client().get('/metrics').status_code, 404)
+        response = create_app(MetricsConfig).test_client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('pools', response.get_json())
+
+    def test_elasticsearch_pool_size(self):
+        class SearchConfig(TestConfig):
+            ENABLE_ELASTICSEARCH = True
+            ELASTICSEARCH_USER = 'elastic'
+            ELASTICSEARCH_PASSWORD = 'secret'
+            ELASTICSEARCH_CONNECTIONS_PER_NODE = 3
+
+        app = create_app(SearchConfig)
+        # the urllib3 pool the client really uses, not the config value
+        node, = app.elasticsearch.transport.node_pool.all()
+        self.assertEqual(node.pool.pool.maxsize, 3)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file